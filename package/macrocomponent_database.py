@@ -1,25 +1,1057 @@
 import psycopg as pg
 import random as rd
 import pandas as pd
+import numpy as np
+import ijson # Package to parse JSON iteratively
+import time
+import hashlib
+import decimal
+import fractions
+import math
+import itertools
+import json
+import os
+import codecs
+import queue
+import threading
+import multiprocessing.util
+from collections import OrderedDict
+from xml.parsers import expat # Fast non-validating XML parser
+from concurrent.futures import ProcessPoolExecutor
+from psycopg_pool import ConnectionPool, AsyncConnectionPool
 from IPython.display import clear_output # Function to clear output when counting rows
         
 # This is a rough attempt at putting some of the most important functions from the Jupyter notebooks into an importable package
 
+# Building parts that are associated with macrocomponents: table listing the possible types, mapping table and column, and how the list of possible types is narrowed down for each building.
+# 'material': the type must list the building's BBR material code (bbr_column) in its bbr_material_id column.
+# 'pitch': the building's roof pitch (bbr_column) must be between the type's min_pitch and max_pitch.
+# None: all types are possible, only the construction year is used.
+linked_elements={
+    'ext_wall':{'types':'ext_wall_types','mapping':'buildings_to_ext_walls','column':'ext_wall_id','subcomponents':'ext_walls_to_subcomponents','criterion':'material','bbr_column':'byg032ydervæggensmateriale'},
+    'roof_cover':{'types':'roof_cover_types','mapping':'buildings_to_roof_covers','column':'roof_cover_id','subcomponents':'roof_covers_to_subcomponents','criterion':'material','bbr_column':'byg033tagdækningsmateriale'},
+    'roof_structure':{'types':'roof_structure_types','mapping':'buildings_to_roof_structures','column':'roof_structure_id','subcomponents':'roof_structures_to_subcomponents','criterion':'pitch','bbr_column':'roof_pitch','types_filter':"name NOT IN ('Ridge board', 'Top floor ceiling')"},
+    'floor':{'types':'floor_types','mapping':'buildings_to_floors','column':'floor_id','subcomponents':'floors_to_subcomponents','criterion':None},
+    'int_wall':{'types':'int_wall_types','mapping':'buildings_to_int_walls','column':'int_wall_id','subcomponents':'int_walls_to_subcomponents','criterion':None},
+    'ground_slab':{'types':'ground_slab_types','mapping':'buildings_to_ground_slabs','column':'ground_slab_id','subcomponents':'ground_slabs_to_subcomponents','criterion':None},
+    'foundation':{'types':'foundation_types','mapping':'buildings_to_foundations','column':'foundation_id','subcomponents':'foundations_to_subcomponents','criterion':None},
+}
+
+# NumPy types of the numeric PostgreSQL columns (by type oid) in fetched results, see macrocomponent_database.fetch_frame.
+# Other columns are fetched as Python objects, or as categories.
+column_dtypes={21:np.int16,23:np.int32,20:np.int64,700:np.float32,701:np.float64,1700:np.float64}
+
+def typed_column(values,type_code):
+    # Array of the values of a fetched column, with the NumPy type matching its PostgreSQL type (type_code) if it is numeric
+    if type_code in column_dtypes:
+        return np.array(values,dtype=float if None in values else column_dtypes[type_code])
+    column=np.empty(len(values),dtype=object)
+    column[:]=values
+    return column
+
+class frame_builder:
+    # Builds a DataFrame column by column from batches of fetched rows, so that the rows are never all held as Python tuples.
+    # Numeric columns get NumPy types (float when they contain NULL values) and the columns listed in categorical are stored as pandas categories.
+    def __init__(self,description,categorical=()):
+        self.names=[c.name for c in description]
+        self.types=[c.type_code for c in description]
+        self.categorical=[n in categorical for n in self.names]
+        self.chunks=[[] for n in self.names]
+        self.categories=[{} for n in self.names] # Code of each category, for categorical columns
+
+    def add(self,rows):
+        for n,values in enumerate(zip(*rows)):
+            if self.categorical[n]:
+                codes=self.categories[n]
+                self.chunks[n].append(np.array([-1 if v is None else codes.setdefault(v,len(codes)) for v in values],dtype=np.int32))
+            else:
+                self.chunks[n].append(typed_column(values,self.types[n]))
+
+    def frame(self):
+        columns={}
+        for n,name in enumerate(self.names):
+            if self.categorical[n]:
+                codes=np.concatenate(self.chunks[n]) if self.chunks[n] else np.empty(0,dtype=np.int32)
+                columns[name]=pd.Categorical.from_codes(codes,list(self.categories[n]))
+            elif self.chunks[n]:
+                columns[name]=np.concatenate(self.chunks[n])
+            else:
+                columns[name]=np.empty(0,dtype=column_dtypes.get(self.types[n],object))
+            self.chunks[n]=None # Release the chunks as soon as the column is built
+        return pd.DataFrame(columns)
+
+# Queries of building properties and results, shared by macrocomponent_database and async_macrocomponent_database
+result_categories=('element','product','material_type') # Columns of the results stored as categories
+material_types_sql="SELECT DISTINCT material_type FROM products WHERE material_type IS NOT NULL ORDER BY material_type"
+
+def properties_sql(parameter_list,where='',order=''):
+    # The building id is always selected first, and used as the index of the results (see properties_index)
+    return "SELECT id_lokalId AS bbr_index, "+', '.join(parameter_list)+" FROM buildings "+where+order
+
+def properties_index(results,parameter_list):
+    index=results.pop('bbr_index').tolist()
+    results.columns=list(parameter_list)
+    results.index=index
+    return results
+
+def results_sql(where='',order='bbr_id'):
+    return """
+    SELECT
+    rw.bbr_id bbr_id,
+    rw.element element,
+    rw.product product,
+    weight,
+    material_type
+    FROM results_weights rw
+    %s
+    ORDER BY %s
+    """ % (where,order)
+
+def material_amounts_sql(materials,where=''):
+    # Single pass pivot of the results: one row per building with the total weight (in kg) of each material type in a separate column.
+    # materials is the list of material types in the products table (see material_types_sql), passed as parameters, where an optional condition on the results.
+    # The material columns are named m0, m1... in the query and renamed with material_columns, so that material type names are never part of the SQL.
+    columns=[pg.sql.SQL("SUM(weight) FILTER (WHERE rw.material_type = %s) AS {}").format(pg.sql.Identifier('m%d' % i)) for i in range(len(materials))]
+    return pg.sql.SQL("""
+    SELECT
+    {}
+    FROM results_weights rw
+    {}
+    GROUP BY rw.bbr_id
+    """).format(pg.sql.SQL(', ').join([pg.sql.SQL('rw.bbr_id')]+columns),pg.sql.SQL(where))
+
+def material_columns(materials):
+    # Names of the material columns of material_amounts_sql: the material types in lower case, or as they are if two types only differ by case
+    lower=[m.lower() for m in materials]
+    return [l if lower.count(l)==1 else m for m,l in zip(materials,lower)]
+
+# The results_weights table queried by results_sql and material_amounts_sql (see macrocomponent_database.refresh_weights)
+results_weights_table_sql="""
+CREATE TABLE IF NOT EXISTS results_weights (
+    bbr_id character varying(50),
+    element character varying,
+    product text,
+    material_type character varying,
+    weight real)"""
+results_weights_index_sql="CREATE INDEX IF NOT EXISTS results_weights_bbr_id ON results_weights (bbr_id)"
+results_weights_insert_sql="""
+INSERT INTO results_weights(bbr_id, element, product, material_type, weight)
+SELECT
+rma.bbr_id,
+rma.element,
+rma.product,
+pr.material_type,
+(CASE WHEN unit='KG' THEN amount WHEN unit='M3' THEN amount*pr.density ELSE NULL END)
+FROM results_material_amounts rma
+INNER JOIN products pr ON rma.product=pr.name
+"""
+# Databases filled before results_weights was introduced get the table on their first query. The lock makes sure that only one process fills it.
+ensure_weights_sql=["SELECT pg_advisory_xact_lock(hashtext('results_weights'))","SELECT to_regclass('results_weights') IS NULL"]
+
+# Spatial grid used to index the building coordinates (byg404Koordinat, in metres in EPSG:25832 for BBR), see macrocomponent_database.parse_coordinates.
+# Each building is assigned to a square cell of grid_size metres, numbered grid_x*grid_rows+grid_y, so that the cells of a column of the grid are consecutive numbers.
+grid_size=1000.0
+grid_rows=1<<20
+
+# Arrow types of the PostgreSQL columns (by type oid) written to Parquet files, see macrocomponent_database.export_parquet. Other columns are written as text.
+arrow_types={16:'bool_',21:'int16',23:'int32',20:'int64',700:'float32',701:'float64',1700:'float64'}
+
+# Dimensions of the material cube (see macrocomponent_database.refresh_material_cube), from the coarsest to the finest
+cube_dimensions=['kommunekode','use_code','decade','element','material_type']
+cube_types={'kommunekode':(int,'smallint'),'use_code':(str,'varchar'),'decade':(int,'smallint'),'element':(str,'varchar'),'material_type':(str,'varchar')} # Python and SQL type of each dimension
+# Cell of the cube, with NULL dimensions replaced by values that do not occur, so that cells can be matched with = (see refresh_material_cube)
+cube_cell="COALESCE(%skommunekode,-1), COALESCE(%suse_code,''), COALESCE(%sdecade,-1)"
+
+# Roof pitch (in degrees) estimated from the BBR roof cover material (byg033Tagdækningsmateriale), see approx_roof_pitch.
+# Materials that are not listed get the default pitch.
+roof_pitches={2:10,6:10,3:40,5:40,10:40,4:35,90:35,7:20}
+default_roof_pitch=1
+
+# Building parts for which material amounts are calculated, in the order of the quantity columns of geometry_sql (see macrocomponent_database)
+quantified_elements=['ext_wall','window','int_wall','floor','foundation','ground_slab','roof_cover','roof_structure','ridge_board']
+
+def possible_elements(elem_list, id_set, construction_year):
+    # Returns the macrocomponents among which random_possible_element picks: those where the construction year is between the component's min and max years of use,
+    # otherwise those where the construction year is after the max year, otherwise those where it is before the min year.
+    # elem_list is a list of tuples where the first element is the macrocomponent id and the 3rd and 4th are min and max years of use. id_set is the set of ids allowed for the building.
+    if construction_year is None:
+        return ()
+    valid_choices=[]
+    early_choices=[]
+    late_choices=[]
+    for elem in elem_list:
+        elem_id=elem[0]
+        min_year=elem[2]
+        max_year=elem[3]
+        if elem_id not in id_set or min_year is None or max_year is None:
+            continue
+        if min_year<=construction_year<=max_year:
+            valid_choices.append(elem)
+        elif max_year<construction_year:
+            late_choices.append(elem)
+        elif construction_year<min_year:
+            early_choices.append(elem)
+    return tuple(valid_choices or late_choices or early_choices)
+
+class candidate_index:
+    # Lookup structure for one catalogue of macrocomponents (list of tuples as returned by "SELECT * FROM ..._types ORDER BY id").
+    # The possible macrocomponents of a building only depend on its construction year and on a key narrowing down the catalogue:
+    # the BBR material code ('material' criterion, matched against the last column, bbr_material_id), the roof pitch ('pitch' criterion, matched against min_pitch and max_pitch)
+    # or nothing (None). Since most buildings share a handful of (key, year) combinations, candidates are resolved once per distinct combination and stored as tuples,
+    # so that picking a macrocomponent for a building is a dictionary lookup followed by a random draw.
+    def __init__(self,elems,criterion=None):
+        self.elems=elems
+        self.criterion=criterion
+        self.id_sets={} # key -> set of ids allowed by the key
+        self.candidates={} # (key, year) -> tuple of candidate macrocomponents
+
+    def allowed_ids(self,key):
+        id_set=self.id_sets.get(key)
+        if id_set is None:
+            if self.criterion=='material':
+                id_set={e[0] for e in self.elems if e[-1] is not None and key in e[-1]}
+            elif self.criterion=='pitch':
+                id_set={e[0] for e in self.elems if key is not None and e[4] is not None and e[5] is not None and e[4]<=key<=e[5]}
+            else:
+                id_set={e[0] for e in self.elems}
+            self.id_sets[key]=id_set
+        return id_set
+
+    def lookup(self,key,construction_year):
+        if self.criterion is None:
+            key=None
+        candidates=self.candidates.get((key,construction_year))
+        if candidates is None:
+            candidates=possible_elements(self.elems,self.allowed_ids(key),construction_year)
+            self.candidates[(key,construction_year)]=candidates
+        return candidates
+
+    def precompute(self,keys,years):
+        # Resolves all distinct (key, year) combinations in one go, e.g. for all buildings of the database
+        for key,year in set(zip(keys,years)):
+            self.lookup(key,year)
+
+    def choose(self,key,construction_year,draw=None):
+        # draw is an optional uniform number in [0,1) (see building_draw), otherwise the global random module is used
+        candidates=self.lookup(key,construction_year)
+        if len(candidates)==0:
+            return None
+        if draw is None:
+            return rd.choice(candidates)
+        return candidates[int(draw*len(candidates))]
+
+# Seeded random draws
+# Each building gets its own uniform draw for each element, derived from a hash of the run seed, the element and the building id.
+# The draw of a building therefore does not depend on which other buildings are processed, in which order or by which worker,
+# so that seeded runs give identical mapping tables whatever the partitioning, the number of workers or the subset of buildings re-linked.
+def building_hash(seed,element,bbr_id):
+    digest=hashlib.blake2b(('%s:%s:%s' % (seed,element,bbr_id)).encode('utf8'),digest_size=8).digest()
+    return int.from_bytes(digest,'little')
+
+def building_draw(seed,element,bbr_id):
+    return (building_hash(seed,element,bbr_id)>>11)*2.0**-53 # 53 random bits, as in random.random()
+
+def building_draws(seed,element,bbr_ids):
+    return np.fromiter((building_draw(seed,element,b) for b in bbr_ids),dtype=float,count=len(bbr_ids))
+
+def iteration_draws(hashes,iteration):
+    # Draws of iteration number iteration of a Monte Carlo run, from the building hashes (uint64 array of building_hash values).
+    # The hash of each building is mixed with the iteration number with the splitmix64 function, which is much faster than hashing the building ids again.
+    with np.errstate(over='ignore'):
+        z=hashes+np.uint64(0x9E3779B97F4A7C15)*np.uint64(iteration+1)
+        z=(z^(z>>np.uint64(30)))*np.uint64(0xBF58476D1CE4E5B9)
+        z=(z^(z>>np.uint64(27)))*np.uint64(0x94D049BB133111EB)
+        z=z^(z>>np.uint64(31))
+    return (z>>np.uint64(11)).astype(float)*2.0**-53
+
+def draw_candidates(table,counts,inverse,draws):
+    # Picks one candidate per building, using one uniform draw in [0,1) per building. table holds the candidate ids of each distinct (key, year) combination, padded with -1,
+    # counts the number of candidates of each combination and inverse the combination of each building (see macrocomponent_database.candidate_table). Returns -1 when there is no candidate.
+    building_counts=counts[inverse]
+    rank=np.floor(draws*building_counts).astype(np.int64) # Position of the chosen type among the building's candidates
+    return table[inverse,rank]
+
+# Monte Carlo ensembles
+# Since macrocomponents are picked at random, one quantification is only one sample of the building stock. An ensemble repeats the assignment of macrocomponents
+# and the quantification in memory, and only keeps running statistics: mean and variance of each material type for each building (Welford's online algorithm),
+# a quantile sketch of each material type for each building (see quantile_sketch), and the total of each material type in the whole stock for each iteration,
+# from which the quantiles of the stock are computed at the end.
+# Amounts are calculated as the quantity of each building part (geometry_sql) times the kg of each material type per unit of quantity of the chosen macrocomponent (load_intensities).
+ensemble_inputs=None # Inputs of the worker processes, set by ensemble_worker_init
+
+# Streaming quantiles of an array of cells (e.g. buildings x material types) receiving one value per cell at each iteration (Munro-Paterson compactors).
+# Values are stored in levels of size items per cell, an item of level l standing for 2**l values. When a level is full, it is sorted and every other
+# item (alternately the odd and even ones) is moved to the next level. Since all cells receive their values at the same time, all cells have the same
+# number of items in each level, so that the levels are plain arrays and compactions are vectorised. Quantiles are exact up to size iterations,
+# their rank error then grows like log2(iterations/size)/size at most (about 2% on average and 5% at most for size 32 and 1000 iterations),
+# and the memory used is 4*size*(log2(iterations/size)+1) bytes per cell. Sketches of the same cells are merged with merge.
+class quantile_sketch:
+    def __init__(self,shape,size=32):
+        self.shape=tuple(shape)
+        self.size=max(2,size-size%2) # Compactions halve the levels, so their size is even
+        self.levels=[] # Items of each level (shape x size, float32)
+        self.fills=[] # Number of items of each level, the same for all cells
+        self.offsets=[] # First item kept by the next compaction of each level
+        self.count=0
+
+    def level(self,l):
+        while len(self.levels)<=l:
+            self.levels.append(np.empty(self.shape+(self.size,),dtype=np.float32))
+            self.fills.append(0)
+            self.offsets.append(0)
+        return self.levels[l]
+
+    def write(self,rows,x):
+        # Values of the current iteration for the cells of rows (a slice of the first axis), followed by advance once all rows are written
+        self.level(0)[rows][...,self.fills[0]]=x
+
+    def advance(self):
+        self.fills[0]+=1
+        self.count+=1
+        if self.fills[0]==self.size:
+            self.compact(0)
+
+    def push(self,l,items):
+        # Appends items (shape x n) to level l, compacting it every time it is full
+        i=0
+        while i<items.shape[-1]:
+            level=self.level(l)
+            n=min(self.size-self.fills[l],items.shape[-1]-i)
+            level[...,self.fills[l]:self.fills[l]+n]=items[...,i:i+n]
+            self.fills[l]+=n
+            i+=n
+            if self.fills[l]==self.size:
+                self.compact(l)
+
+    def compact(self,l):
+        items=np.sort(self.levels[l],axis=-1)[...,self.offsets[l]::2]
+        self.offsets[l]^=1
+        self.fills[l]=0
+        self.push(l+1,items)
+
+    def merge(self,other):
+        # Adds the values of another sketch of the same cells (e.g. computed by another worker)
+        for l,level in enumerate(other.levels):
+            if other.fills[l]>0:
+                self.push(l,level[...,:other.fills[l]])
+        self.count+=other.count
+
+    def quantiles(self,qs,chunk=100000):
+        # Array (quantiles x shape) of the smallest values whose weighted rank is at least q times the number of values, for each q of qs
+        weights=np.concatenate([np.full(f,2.0**l) for l,f in enumerate(self.fills)])
+        results=np.full((len(qs),)+self.shape,np.nan)
+        for start in range(0,self.shape[0],chunk):
+            stop=min(start+chunk,self.shape[0])
+            x=np.concatenate([level[start:stop,...,:f] for level,f in zip(self.levels,self.fills)],axis=-1)
+            if x.shape[-1]==0:
+                break
+            order=np.argsort(x,axis=-1)
+            x=np.take_along_axis(x,order,axis=-1)
+            rank=np.cumsum(weights[order],axis=-1)
+            for j,q in enumerate(qs):
+                k=np.argmax(rank>=q*self.count,axis=-1)
+                results[j,start:stop]=np.take_along_axis(x,k[...,None],axis=-1)[...,0]
+        return results
+
+def ensemble_worker_init(inputs):
+    global ensemble_inputs
+    ensemble_inputs=inputs
+
+def ensemble_worker(iterations):
+    return ensemble_run(ensemble_inputs,iterations)
+
+def ensemble_run(inputs,iterations,chunk=200000):
+    n_buildings=len(inputs['bbr_ids'])
+    n_materials=len(inputs['materials'])
+    mean=np.zeros((n_buildings,n_materials))
+    m2=np.zeros((n_buildings,n_materials))
+    sketch=quantile_sketch((n_buildings,n_materials),inputs['sketch_size']) if inputs['sketch_size']>0 else None
+    totals={}
+    q=inputs['quantities']
+
+    for count,iteration in enumerate(iterations,start=1):
+        total=np.zeros(n_materials)
+        for start in range(0,n_buildings,chunk):
+            stop=min(start+chunk,n_buildings)
+            # Windows do not depend on the random choices
+            x=q[start:stop,quantified_elements.index('window'),None]*inputs['window_intensity']
+            for element,spec in inputs['elements'].items():
+                draws=iteration_draws(spec['hashes'][start:stop],iteration)
+                choices=draw_candidates(spec['table'],spec['counts'],spec['inverse'][start:stop],draws)
+                x+=q[start:stop,quantified_elements.index(element),None]*spec['intensity'][choices+1] # Row 0 of the intensities (no macrocomponent) is zero
+                if element=='roof_structure':
+                    # Pitched roofs also get a ridge board
+                    ridge=spec['has_ridge_board'][choices+1]
+                    x+=(ridge*q[start:stop,quantified_elements.index('ridge_board')])[:,None]*inputs['ridge_board_intensity']
+            delta=x-mean[start:stop]
+            mean[start:stop]+=delta/count
+            m2[start:stop]+=delta*(x-mean[start:stop])
+            if sketch is not None:
+                sketch.write(slice(start,stop),x)
+            total+=x.sum(axis=0)
+        if sketch is not None:
+            sketch.advance()
+        totals[iteration]=total
+    return len(iterations),mean,m2,totals,sketch
+
+# Worker processes are started with spawn rather than fork: a forked child would inherit the threads, locks and open sockets of the parent's connection pool,
+# and could deadlock or use the parent's connections. The workers only need the module-level initializers and functions, which spawn imports.
+worker_context=multiprocessing.get_context('spawn')
+
+link_worker_database=None # Database of the worker processes of macrocomponent_database.link_all_parallel, set by link_worker_init
+
+def link_worker_init(db_params,seed):
+    # One pool (of one connection) per worker process, closed when the process exits
+    global link_worker_database
+    link_worker_database=macrocomponent_database(db_params,[],pool_min_size=1,pool_max_size=1,seed=seed)
+    multiprocessing.util.Finalize(link_worker_database,link_worker_database.close,exitpriority=10)
+
+def link_shard_worker(elements,where,params,run):
+    return link_worker_database.link_shard(elements,where,params,run)
+
+# PostgreSQL arithmetic used by quantification_engine. Parameters are formatted into the SQL queries with %s, so an integer parameter is an
+# integer literal and any other parameter is an exact numeric literal, whose arithmetic is exact (divisions and powers are rounded to a scale
+# chosen from the operands). A numeric mixed with double precision values is converted to double precision.
+def sql_constant(value):
+    text=str(value)
+    try:
+        return int(text)
+    except ValueError:
+        return decimal.Decimal(text)
+
+def numeric_scale(value):
+    return max(-decimal.Decimal(value).as_tuple().exponent,0)
+
+def numeric_round(value,scale):
+    return value.quantize(decimal.Decimal(1).scaleb(-scale),rounding=decimal.ROUND_HALF_UP)
+
+def numeric_div(a,b):
+    # a/b between numerics, rounded to the scale chosen by PostgreSQL (select_div_scale in numeric.c)
+    a=decimal.Decimal(a)
+    b=decimal.Decimal(b)
+    def first_digit(v): # Weight and value of the first base 10000 digit
+        if v==0:
+            return 0,0
+        weight=abs(v).adjusted()//4
+        return weight,int(abs(v).scaleb(-4*weight))
+    weight_a,digit_a=first_digit(a)
+    weight_b,digit_b=first_digit(b)
+    qweight=weight_a-weight_b-(1 if digit_a<=digit_b else 0)
+    scale=min(max(16-qweight*4,numeric_scale(a),numeric_scale(b),0),1000)
+    with decimal.localcontext() as ctx:
+        ctx.prec=scale+max(a.adjusted()-b.adjusted(),0)+40
+        return numeric_round(a/b,scale)
+
+def numeric_power(base,exponent):
+    # base^exponent for a positive base and a non-integer exponent, rounded to the scale chosen by PostgreSQL (power_var in numeric.c)
+    base=decimal.Decimal(base)
+    exponent=decimal.Decimal(exponent)
+    weight=math.log(base)*float(exponent)*0.434294481903252 # Approximate decimal weight of the result
+    scale=min(max(16-int(weight),numeric_scale(base),numeric_scale(exponent),0),1000)
+    with decimal.localcontext() as ctx:
+        ctx.prec=scale+abs(int(weight))+40
+        return numeric_round((exponent*base.ln()).exp(),scale)
+
+def exact_float32(numerators,denominator,null):
+    # numerators/denominator (exact integers) correctly rounded to real, as when a numeric value is stored in a real column. NaN where null is True.
+    numerators=np.where(null,0,numerators).astype(np.int64)
+    exact=np.abs(numerators)<(1<<53) # Integers represented exactly by doubles, whose quotient is rounded once
+    value=numerators/float(denominator)
+    result=value.astype(np.float32)
+    # Rounding to double first, then to real only differs from a single rounding if the double falls exactly halfway between two reals
+    neighbour=np.nextafter(result,np.where(value>result,np.float32(np.inf),np.float32(-np.inf)).astype(np.float32))
+    halfway=(value!=result)&(value==(result.astype(np.float64)+neighbour.astype(np.float64))/2)
+    for n in np.flatnonzero(halfway|~exact):
+        q=fractions.Fraction(int(numerators[n]),denominator)
+        low=np.float32(float(q))
+        high=np.nextafter(low,np.float32(np.inf) if fractions.Fraction(float(low))<q else np.float32(-np.inf))
+        low,high=sorted((low,high))
+        middle=(fractions.Fraction(float(low))+fractions.Fraction(float(high)))/2
+        if q<middle or (q==middle and int(low.view(np.int32))%2==0):
+            result[n]=low
+        else:
+            result[n]=high
+    result[null]=np.nan
+    return result
+
+# Use codes of the buildings whose internal walls are estimated with each formula of estimate_lb_internal_walls and estimate_nlb_internal_walls
+residential_use_codes=[110, 120, 121, 122, 130, 131, 132, 325, 510, 520, 521, 522, 523, 529, 530, 540, 585, 590]
+compactness_use_codes=[140, 150, 160, 185, 190, 320, 321, 322, 324, 329, 390, 410, 411, 412, 413, 414, 415, 419, 531, 532, 533, 534, 539]
+light_use_codes=[323, 416, 535]
+
+# Quantification of the material amounts in memory, without the database. The engine computes the same results as estimate_lb_internal_walls,
+# estimate_nlb_internal_walls and calculate_material_amounts (rows of results_material_amounts) with NumPy arrays, so that the quantities can be
+# recomputed for other values of default_floor_height, window_wall_ratio and space_efficiency at memory speed.
+# The results match the database exactly because every expression is evaluated with the types PostgreSQL gives it: integer division of the areas,
+# exact numeric constants, double precision otherwise, real arithmetic for the internal walls, and real for the stored amounts. NULL values are NaN.
+# Inputs (see macrocomponent_database.engine_inputs):
+# buildings: columns of the buildings table (id_lokalid, byg021bygningensanvendelse, byg038samletbygningsareal, byg041bebyggetareal, byg054antaletager,
+#            roof_pitch and optionally int_wall_surface_lb and int_wall_surface_nlb, which are otherwise estimated)
+# links: for each element of linked_elements, a DataFrame of its mapping table (bbr_id and the element's column)
+# catalogue: 'types' (for each element, id and name of its types), 'subcomponents' (for each element, its table of subcomponents), and the
+#            'subcomponent_names', 'subcomponents_to_products' and 'products' tables
+# Only exact in this sense: overflows and divisions by zero, which raise errors in the database, give infinities or NaN here, and the rounding of
+# numeric powers and cosines relies on the same libm as the database server.
+class quantification_engine:
+    def __init__(self,default_floor_height=3.5,window_wall_ratio=0.2,space_efficiency=1.2):
+        self.default_floor_height=default_floor_height
+        self.window_wall_ratio=window_wall_ratio
+        self.space_efficiency=space_efficiency
+        h=sql_constant(default_floor_height)
+        r=sql_constant(window_wall_ratio)
+        s=sql_constant(space_efficiency)
+        self.height=h
+        self.height_float=float(h)
+        self.wall_float=float(1-r)
+        self.window_float=float(r)
+        self.efficiency_float=float(s)
+        # (s+1/s) of get_perimeter_sql
+        self.perimeter_float=float(s+int(1/s)) if isinstance(s,int) else float(s+numeric_div(1,s))
+
+    def column(self,buildings,name,dtype=np.float64):
+        # Column of the buildings as an array of floats (NULL is NaN)
+        return pd.to_numeric(pd.Series(np.asarray(buildings[name])),errors='coerce').to_numpy(dtype=dtype)
+
+    def arrays(self,buildings):
+        columns={c:self.column(buildings,c) for c in ['byg021bygningensanvendelse','byg038samletbygningsareal','byg041bebyggetareal','byg054antaletager','roof_pitch']}
+        columns['floor_area']=np.where(np.isnan(columns['byg038samletbygningsareal']),columns['byg041bebyggetareal'],columns['byg038samletbygningsareal'])
+        return columns
+
+    def perimeter(self,b):
+        floors=b['byg054antaletager']
+        no_floors=np.isnan(floors)|(floors==0)
+        with np.errstate(divide='ignore',invalid='ignore'):
+            area=np.where(no_floors,b['byg041bebyggetareal'],np.trunc(b['byg038samletbygningsareal']/floors)) # Integer division
+            return np.sqrt(area)*2*self.perimeter_float
+
+    def use_formulas(self,b):
+        # Formula of the internal walls of each building (0, 1 or 2 in the order of the use codes lists above, -1 if not estimated)
+        use_code=b['byg021bygningensanvendelse']
+        return np.select([np.isin(use_code,residential_use_codes),
+                          np.isin(use_code,compactness_use_codes)|((use_code>=420)&(use_code<490)),
+                          ((use_code>=210)&(use_code<319))|np.isin(use_code,light_use_codes)],[0,1,2],-1)
+
+    def estimate_lb_internal_walls(self,b):
+        floor_area=b['floor_area']
+        formula=self.use_formulas(b)
+        null=np.isnan(floor_area)
+        area=np.where(null,0,floor_area).astype(np.int64)
+        return np.select([formula==0,formula==1,formula==2],
+                         [exact_float32(222*area,1000,null), # 0.222*floor_area
+                          exact_float32(area*(40630000+3489*area),10**8,null), # floor_area*(0.4063+0.00003489*floor_area)
+                          exact_float32(area,10,null)], # floor_area*0.1
+                         np.float32(np.nan)).astype(np.float32)
+
+    def estimate_nlb_internal_walls(self,b):
+        floor_area=b['floor_area']
+        floors=b['byg054antaletager']
+        formula=self.use_formulas(b)
+        null=np.isnan(floor_area)
+        area=np.where(null,0,floor_area).astype(np.int64)
+
+        # Compactness of the buildings estimated with it: external surface / volume^0.666667, where the volume is numeric and so is its power
+        compact=(formula==1)&~null
+        perimeter=self.perimeter(b)
+        no_floors=np.isnan(floors)|(floors==0)
+        external_surface=np.where(no_floors,b['byg041bebyggetareal']+perimeter*self.height_float,b['byg041bebyggetareal']+perimeter*floors*self.height_float)
+        powers=np.full(len(area),np.nan)
+        values,inverse=np.unique(area[compact],return_inverse=True) # Few distinct floor areas
+        exponent=decimal.Decimal('0.666667')
+        powers[compact]=np.array([float(numeric_power(self.height*v,exponent)) if self.height*v>0 else np.nan for v in values.tolist()]+[np.nan])[inverse.reshape(-1)]
+        with np.errstate(invalid='ignore'):
+            icomp=external_surface/powers
+
+        return np.select([formula==0,formula==1,formula==2],
+                         [exact_float32(37*area,100,null), # 0.37*floor_area
+                          (floor_area*(0.1803+0.0883*icomp)).astype(np.float32),
+                          exact_float32(15*area,100,null)], # floor_area*0.15
+                         np.float32(np.nan)).astype(np.float32)
+
+    def quantities(self,buildings):
+        # Quantity of each building part of each building, by which the amounts of products per unit are multiplied (see geometry_sql).
+        # The quantity of internal walls is real, the others are double precision.
+        b=self.arrays(buildings)
+        floors=b['byg054antaletager']
+        area=b['byg041bebyggetareal']
+        perimeter=self.perimeter(b)
+        if 'int_wall_surface_lb' in buildings and 'int_wall_surface_nlb' in buildings:
+            lb=self.column(buildings,'int_wall_surface_lb',np.float32)
+            nlb=self.column(buildings,'int_wall_surface_nlb',np.float32)
+        else:
+            lb=self.estimate_lb_internal_walls(b)
+            nlb=self.estimate_nlb_internal_walls(b)
+        has_floors=~np.isnan(floors)
+        pitch=b['roof_pitch']
+        values,inverse=np.unique(np.nan_to_num(pitch),return_inverse=True)
+        cosine=np.array([math.cos(v*math.pi*180) for v in values.tolist()])[inverse.reshape(-1)] # Few distinct pitches, cosines computed by libm
+        cosine[np.isnan(pitch)]=np.nan
+        with np.errstate(divide='ignore',invalid='ignore'):
+            roof=area/cosine
+            return {'ext_wall':np.where(has_floors,perimeter*floors*self.height_float*self.wall_float,perimeter*self.height_float*self.wall_float),
+                    'window':np.where(has_floors,perimeter*floors*self.height_float*self.window_float,perimeter*self.height_float*self.window_float),
+                    'int_wall':nlb+lb,
+                    'floor':np.where(has_floors,area*(floors-1),0),
+                    'foundation':area,
+                    'ground_slab':area,
+                    'roof_cover':roof,
+                    'roof_structure':roof,
+                    'ridge_board':np.sqrt(area)*self.efficiency_float}
+
+    def product_edges(self,catalogue,subcomponents):
+        # Products of each row of a table of subcomponents (amount per unit as real, and unit), as in the joins of the amounts_* functions
+        edges=subcomponents.merge(catalogue['subcomponent_names'][['lcabyg_id']],left_on='subcomponent_id',right_on='lcabyg_id')
+        edges=edges.drop(columns='lcabyg_id').merge(catalogue['subcomponents_to_products'][['subcomponent_id','product_id','amount','unit']],on='subcomponent_id')
+        edges=edges.merge(catalogue['products'][['lcabyg_id','name']],left_on='product_id',right_on='lcabyg_id')
+        return edges.rename(columns={'name':'product'})
+
+    def material_amounts(self,buildings,links,catalogue):
+        # Rows of results_material_amounts (element, product, amount, unit, bbr_id) computed in memory
+        q=self.quantities(buildings)
+        bbr_ids=pd.Index(np.asarray(buildings['id_lokalid']))
+        frames=[]
+        for element in quantified_elements:
+            if element=='window':
+                names=catalogue['subcomponent_names']
+                window=names.loc[names['name']=='Window - iBuildGreen',['lcabyg_id']].rename(columns={'lcabyg_id':'subcomponent_id'})
+                edges=self.product_edges(catalogue,window)
+                rows=np.repeat(np.arange(len(bbr_ids)),len(edges))
+                edges=edges.iloc[np.tile(np.arange(len(edges)),len(bbr_ids))]
+            else:
+                spec=linked_elements['roof_structure' if element=='ridge_board' else element]
+                column=spec['column']
+                types=catalogue['types']['roof_structure' if element=='ridge_board' else element]
+                if element=='ridge_board':
+                    types=types[types['name']=='Ridge board']
+                elif element=='roof_structure':
+                    types=types[~types['name'].isin(['Ridge board','Top floor ceiling'])]
+                edges=self.product_edges(catalogue,catalogue['subcomponents'][element if element!='ridge_board' else 'roof_structure'][[column,'subcomponent_id']])
+                edges=links['roof_structure' if element=='ridge_board' else element][['bbr_id',column]].dropna().merge(types[['id']],left_on=column,right_on='id').merge(edges,on=column)
+                rows=bbr_ids.get_indexer(edges['bbr_id'])
+                edges=edges[rows>=0]
+                rows=rows[rows>=0]
+
+            if element=='int_wall':
+                amount=q[element][rows]*edges['amount'].to_numpy(dtype=np.float32) # Real arithmetic
+            else:
+                amount=(q[element][rows]*edges['amount'].to_numpy(dtype=np.float32).astype(np.float64)).astype(np.float32)
+            frames.append(pd.DataFrame({'element':element,'product':edges['product'].to_numpy(),'amount':amount,'unit':edges['unit'].to_numpy(),'bbr_id':bbr_ids.to_numpy()[rows]}))
+        return pd.concat(frames,ignore_index=True)
+
+# Terms of the quantities used by macrocomponent_database.parameter_sweep, and their factors depending on the parameters, where c is the
+# (s+1/s) factor of the perimeter. Internal walls estimated from the compactness have a surface of
+# floor_area*(0.1803+0.0883*(area+perimeter*floors*h)/(h*floor_area)^e), which is split into a fixed term and two terms in h^-e and c*h^(1-e).
+compactness_exponent=0.666667
+sweep_terms=['fixed','wall','window','ridge_board','compactness_area','compactness_wall']
+
+def sweep_factors(engine):
+    c=engine.perimeter_float
+    h=engine.height_float
+    return [1,c*h*engine.wall_float,c*h*engine.window_float,engine.efficiency_float,h**-compactness_exponent,c*h**(1-compactness_exponent)]
+
+# Sparse matrices of the stock (see macrocomponent_database.stock_matrices), with scipy.sparse:
+# geometry: buildings x macrocomponents, the quantity of the building part for each macrocomponent type linked to each building
+# amounts: macrocomponents x products, the amount of each product per unit of quantity of each type
+# densities: products x material types, the kg per unit of each product (1 for KG, the density for M3)
+# Macrocomponents are (element, type id) pairs of macrocomponent_intensities (type id -1 for windows) and products are (name, unit) pairs, since units
+# are given by the LCAbyg edges. The weight of each material type in each building is geometry @ amounts @ densities, and a scenario only needs
+# another geometry matrix (see geometry_matrix). The matrices and their labels are saved to and loaded from a single .npz file.
+class stock_matrices:
+    def __init__(self,bbr_ids,macrocomponents,products,materials,geometry,amounts,densities):
+        self.bbr_ids=np.asarray(bbr_ids)
+        self.macrocomponents=macrocomponents # DataFrame of element and type_id
+        self.products=products # DataFrame of product and unit
+        self.materials=list(materials)
+        self.geometry=geometry
+        self.amounts=amounts
+        self.densities=densities
+
+    def intensities(self):
+        # kg of each material type per unit of quantity of each macrocomponent (macrocomponents x material types)
+        return self.amounts@self.densities
+
+    def material_weights(self,keys=None,geometry=None):
+        # Weight in kg of each material type in each building, or summed by key if keys (one per building, e.g. municipality codes) is given.
+        # geometry replaces the geometry matrix, e.g. for another scenario.
+        import scipy.sparse as sparse
+        weights=(self.geometry if geometry is None else geometry)@self.intensities()
+        if keys is None:
+            return pd.DataFrame(weights.toarray(),index=pd.Index(self.bbr_ids,name='bbr_id'),columns=self.materials)
+        codes,uniques=pd.factorize(np.asarray(keys),use_na_sentinel=False)
+        groups=sparse.csr_matrix((np.ones(len(codes)),(codes,np.arange(len(codes)))),shape=(len(uniques),len(codes)))
+        return pd.DataFrame((groups@weights).toarray(),index=uniques,columns=self.materials)
+
+    def save(self,path):
+        arrays={'bbr_ids':self.bbr_ids.astype(str),'elements':self.macrocomponents['element'].to_numpy(dtype=str),
+                'type_ids':self.macrocomponents['type_id'].to_numpy(dtype=np.int64),'products':self.products['product'].to_numpy(dtype=str),
+                'units':self.products['unit'].to_numpy(dtype=str),'materials':np.array(self.materials,dtype=str)}
+        for name in ['geometry','amounts','densities']:
+            matrix=getattr(self,name).tocsr()
+            arrays.update({name+'_data':matrix.data,name+'_indices':matrix.indices,name+'_indptr':matrix.indptr,name+'_shape':np.array(matrix.shape)})
+        np.savez_compressed(path,**arrays)
+
+def load_stock_matrices(path):
+    import scipy.sparse as sparse
+    with np.load(path) as f:
+        matrices=[sparse.csr_matrix((f[name+'_data'],f[name+'_indices'],f[name+'_indptr']),shape=tuple(f[name+'_shape'])) for name in ['geometry','amounts','densities']]
+        return stock_matrices(f['bbr_ids'],pd.DataFrame({'element':f['elements'],'type_id':f['type_ids']}),pd.DataFrame({'product':f['products'],'unit':f['units']}),
+                              list(f['materials']),*matrices)
+
+def geometry_matrix(bbr_ids,quantities,links,macrocomponents):
+    # Buildings x macrocomponents matrix of the quantities of the building parts (as returned by quantification_engine.quantities), for the types
+    # linked to each building (links are the mapping tables, as in quantification_engine.material_amounts)
+    import scipy.sparse as sparse
+    buildings=pd.Index(bbr_ids)
+    columns=pd.MultiIndex.from_frame(macrocomponents[['element','type_id']])
+    rows,cols,values=[],[],[]
+    for element in quantified_elements:
+        quantity=np.nan_to_num(np.asarray(quantities[element],dtype=np.float64)) # NULL quantities give NULL amounts, which are ignored when summing weights
+        if element=='window':
+            row=np.arange(len(buildings))
+            col=np.full(len(buildings),columns.get_indexer([('window',-1)])[0])
+        else:
+            # Ridge boards are roof structures, linked to the buildings by add_ridge_board
+            spec=linked_elements['roof_structure' if element=='ridge_board' else element]
+            link=links['roof_structure' if element=='ridge_board' else element].dropna()
+            row=buildings.get_indexer(link['bbr_id'])
+            col=columns.get_indexer(pd.MultiIndex.from_arrays([np.full(len(link),element),link[spec['column']].to_numpy(dtype=np.int64)]))
+        keep=(row>=0)&(col>=0)
+        rows.append(row[keep])
+        cols.append(col[keep])
+        values.append(quantity[row[keep]])
+    return sparse.csr_matrix((np.concatenate(values),(np.concatenate(rows),np.concatenate(cols))),shape=(len(buildings),len(columns)))
+
+# Streaming reader of BBR files, either JSON (buildings in the BygningList array) or XML (Bygning elements, see notebook 1b).
+# The file is parsed in a producer thread which feeds a bounded queue of batches, written to the database by copy_bbr_rows in the calling thread.
+# After each batch, the byte offset of the last recorded building is saved in checkpoint_file, so that an interrupted import resumes by seeking
+# to that offset instead of parsing the whole file again. The checkpoint is deleted once the whole file has been recorded.
+class bbr_reader:
+    def __init__(self,db,path,file_format=None,columns=None,batch_size=None,queue_size=4,checkpoint_file=None,chunk_size=1<<20):
+        self.db=db
+        self.path=path
+        if file_format is None:
+            file_format='xml' if path.lower().endswith('.xml') else 'json'
+        self.file_format=file_format
+        self.columns=list(db.bbr_params if columns is None else columns) # Parameters missing from a building are recorded as NULL
+        self.batch_size=db.batch_size if batch_size is None else batch_size
+        self.queue_size=queue_size
+        self.checkpoint_file=path+'.checkpoint' if checkpoint_file is None else checkpoint_file
+        self.chunk_size=chunk_size
+
+    def load_checkpoint(self):
+        if not os.path.exists(self.checkpoint_file):
+            return None
+        with open(self.checkpoint_file,encoding='utf8') as f:
+            checkpoint=json.load(f)
+        # A checkpoint written for another file (or for an older version of the same file) is ignored
+        if checkpoint.get('path')!=os.path.abspath(self.path) or checkpoint.get('size')!=os.path.getsize(self.path) or checkpoint.get('format')!=self.file_format:
+            print('The checkpoint does not match '+self.path+', reading from the start of the file')
+            return None
+        return checkpoint
+
+    def save_checkpoint(self,position,n_buildings):
+        checkpoint={'path':os.path.abspath(self.path),'size':os.path.getsize(self.path),'format':self.file_format,'buildings':n_buildings}
+        checkpoint.update(position)
+        with open(self.checkpoint_file+'.tmp','w',encoding='utf8') as f:
+            json.dump(checkpoint,f)
+        os.replace(self.checkpoint_file+'.tmp',self.checkpoint_file) # Atomic, so a crash never leaves a half-written checkpoint
+
+    def parse_json(self,f,position):
+        # Yields each building as a dictionary, with the position right after it. A resumed file is read directly inside the BygningList array.
+        decoder=json.JSONDecoder()
+        utf8=codecs.getincrementaldecoder('utf8')()
+        offset=0 if position is None else position['offset'] # Byte offset of text[pos] in the file
+        f.seek(offset)
+        text=''
+        pos=0
+        eof=False
+
+        def read_more():
+            nonlocal text,pos,eof
+            if pos>0: # Drop the text that has already been consumed
+                text=text[pos:]
+                pos=0
+            chunk=f.read(self.chunk_size)
+            eof=len(chunk)==0
+            text+=utf8.decode(chunk,final=eof)
+            return not eof
+
+        def consume(end):
+            nonlocal offset,pos
+            offset+=len(text[pos:end].encode('utf8'))
+            pos=end
+
+        def next_char(skip):
+            # Skips the given characters and returns the next one ('' at the end of the file)
+            while True:
+                while pos<len(text) and text[pos] in skip:
+                    consume(pos+1)
+                if pos<len(text):
+                    return text[pos]
+                if not read_more():
+                    return ''
+
+        if position is None:
+            # Find the start of the building list
+            key='"BygningList"'
+            while True:
+                start=text.find(key,pos)
+                if start>=0:
+                    consume(start+len(key))
+                    break
+                consume(max(pos,len(text)-len(key))) # Keep the end of the text, in case the key is split between two chunks
+                if not read_more():
+                    return
+            for expected in ':[':
+                if next_char(' \t\r\n')!=expected:
+                    raise ValueError('BygningList is not a list at byte %s' % offset)
+                consume(pos+1)
+
+        while next_char(' \t\r\n,') not in (']',''):
+            while True:
+                try:
+                    building,end=decoder.raw_decode(text,pos)
+                    break
+                except json.JSONDecodeError:
+                    if not read_more(): # The building is incomplete unless the end of the file has been reached
+                        raise
+            consume(end)
+            yield building,{'offset':offset}
+
+    def parse_xml(self,f,position):
+        # Yields each building as a dictionary, with the position of its end tag and the tags of its ancestors.
+        # Namespace processing is off and tags are matched on their local names. A resumed file is read after the end tag of the last recorded building,
+        # with the start tags of its ancestors as a synthetic prefix so that the rest of the document is well-formed.
+        parser=expat.ParserCreate()
+        parser.buffer_text=True
+        stack=[] # Tags of the open elements
+        buildings=[]
+        state={'building':None,'field':None,'text':[],'done':False}
+
+        def start_element(name,attrs):
+            stack.append(name)
+            local=name.rsplit(':',1)[-1]
+            if state['building'] is None:
+                if local=='Bygning':
+                    state['building']={}
+                    state['depth']=len(stack)
+            elif len(stack)==state['depth']+1: # Parameter of the building
+                state['field']=local
+                state['text']=[]
+                state['nil']=any(k.rsplit(':',1)[-1]=='nil' and v=='true' for k,v in attrs.items())
+
+        def char_data(data):
+            if state['field'] is not None and len(stack)==state['depth']+1:
+                state['text'].append(data)
+
+        def end_element(name):
+            local=name.rsplit(':',1)[-1]
+            if state['building'] is not None:
+                if len(stack)==state['depth']+1 and state['field'] is not None:
+                    value=''.join(state['text']).strip()
+                    state['building'][state['field']]=None if state['nil'] or value=='' else value
+                    state['field']=None
+                elif len(stack)==state['depth']:
+                    buildings.append((state['building'],{'offset':base+parser.CurrentByteIndex,'ancestors':stack[:-1]}))
+                    state['building']=None
+            elif local=='BygningList':
+                state['done']=True
+            stack.pop()
+
+        parser.StartElementHandler=start_element
+        parser.CharacterDataHandler=char_data
+        parser.EndElementHandler=end_element
+
+        base=0 # Byte offset in the file of the first byte given to the parser
+        if position is not None:
+            f.seek(position['offset'])
+            chunk=f.read(self.chunk_size)
+            while b'>' not in chunk: # The end tag of the last recorded building may be longer than a chunk
+                more=f.read(self.chunk_size)
+                if len(more)==0:
+                    raise ValueError('end of the last recorded building not found at byte %s' % position['offset'])
+                chunk+=more
+            skip=chunk.index(b'>')+1 # End tag of the last recorded building
+            prefix=''.join(['<%s>' % tag for tag in position['ancestors']]).encode('utf8')
+            base=position['offset']+skip-len(prefix)
+            parser.Parse(prefix+chunk[skip:],False)
+            yield from buildings
+            buildings.clear()
+
+        while not state['done']:
+            chunk=f.read(self.chunk_size)
+            parser.Parse(chunk,len(chunk)==0)
+            yield from buildings
+            buildings.clear()
+            if len(chunk)==0:
+                break
+
+    def put(self,batches,stop,item):
+        # Waits for room in the queue, unless the writer has stopped
+        while not stop.is_set():
+            try:
+                batches.put(item,timeout=0.5)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce(self,batches,stop,position):
+        try:
+            parse=self.parse_xml if self.file_format=='xml' else self.parse_json
+            with open(self.path,'rb') as f:
+                batch=[]
+                for building,end in parse(f,position):
+                    batch.append(tuple(building.get(c) for c in self.columns))
+                    if len(batch)>=self.batch_size:
+                        if not self.put(batches,stop,(batch,end)):
+                            return
+                        batch=[]
+                if len(batch)>0:
+                    if not self.put(batches,stop,(batch,end)):
+                        return
+            self.put(batches,stop,None) # End of the file
+        except Exception as error:
+            self.put(batches,stop,error) # Parsing errors are raised by the writer
+
+    def run(self):
+        checkpoint=self.load_checkpoint()
+        n_buildings=0 if checkpoint is None else checkpoint['buildings']
+        if checkpoint is not None:
+            print('Resuming after %s buildings, at byte %s' % (n_buildings, checkpoint['offset']))
+        n_start=n_buildings
+        batches=queue.Queue(maxsize=self.queue_size)
+        stop=threading.Event()
+        producer=threading.Thread(target=self.produce,args=(batches,stop,checkpoint),daemon=True)
+        start=time.perf_counter()
+
+        connector=None
+        try:
+            connector = self.db.pool.getconn()
+            producer.start()
+            while True:
+                item=batches.get()
+                if item is None:
+                    break
+                if isinstance(item,Exception):
+                    raise item
+                rows,position=item
+                self.db.copy_bbr_rows(connector,self.columns,rows)
+                n_buildings+=len(rows)
+                self.save_checkpoint(position,n_buildings)
+                clear_output(wait=True)
+                print('%s buildings recorded, %.0f buildings/s' % (n_buildings, (n_buildings-n_start)/(time.perf_counter()-start)))
+
+            if os.path.exists(self.checkpoint_file):
+                os.remove(self.checkpoint_file)
+            elapsed=time.perf_counter()-start
+            print('%s buildings recorded in %.1f s, %.0f buildings/s' % (n_buildings, elapsed, (n_buildings-n_start)/elapsed if elapsed>0 else 0))
+
+        except (Exception, pg.DatabaseError) as error:
+            print('error after '+str(n_buildings)+' buildings: '+str(error))
+        finally:
+            stop.set()
+            if producer.is_alive():
+                producer.join()
+            if connector is not None:
+                self.db.pool.putconn(connector)
+
+# In-process cache of per-building lookups, with least recently used eviction beyond max_size entries and a time to live of ttl seconds.
+# Entries are tagged with the generation of the results in the database (see macrocomponent_database.results_generation), which is bumped every time
+# the links or material amounts are rewritten, so that entries computed from older results are never returned.
+class result_cache:
+    def __init__(self,max_size=1024,ttl=300):
+        self.max_size=max_size
+        self.ttl=ttl
+        self.entries=OrderedDict() # key -> (generation, time of insertion, value)
+        self.lock=threading.Lock()
+        self.generation=None # Last known generation of the results in the database
+        self.checked=0 # Time at which the generation was last read from the database
+        self.hits=0
+        self.misses=0
+
+    def get(self,key):
+        with self.lock:
+            entry=self.entries.get(key)
+            if entry is not None and entry[0]==self.generation and time.monotonic()-entry[1]<self.ttl:
+                self.entries.move_to_end(key)
+                self.hits+=1
+                return entry[2]
+            if entry is not None: # Expired or computed from older results
+                del self.entries[key]
+            self.misses+=1
+            return None
+
+    def put(self,key,value):
+        with self.lock:
+            self.entries[key]=(self.generation,time.monotonic(),value)
+            self.entries.move_to_end(key)
+            while len(self.entries)>self.max_size:
+                self.entries.popitem(last=False)
+
+    def set_generation(self,generation):
+        with self.lock:
+            if generation!=self.generation:
+                self.entries.clear()
+            self.generation=generation
+            self.checked=time.monotonic()
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        return {'hits':self.hits,'misses':self.misses,'size':len(self.entries),'max_size':self.max_size,'ttl':self.ttl,'generation':self.generation}
+
 class macrocomponent_database:
-    def __init__(self,db_params,bbr_params,default_floor_height=3.5,window_wall_ratio=0.2,space_efficiency=1.2):
+    def __init__(self,db_params,bbr_params,default_floor_height=3.5,window_wall_ratio=0.2,space_efficiency=1.2,batch_size=10000,pool_min_size=1,pool_max_size=10,seed=None,cache_size=0,cache_ttl=300,generation_check=1.0):
         self.db_params=db_params
+        # All methods borrow their connections from this pool instead of opening a new connection every time.
+        # Connections are checked before being handed out, so that connections dropped by the server are replaced transparently.
+        self.pool=ConnectionPool(db_params,min_size=pool_min_size,max_size=pool_max_size,check=ConnectionPool.check_connection,open=True)
         self.bbr_params=bbr_params
+        self.batch_size=batch_size # Number of buildings sent to the database at once when importing BBR data in bulk
         self.default_floor_height=default_floor_height
         self.window_wall_ratio=window_wall_ratio
         self.space_efficiency=space_efficiency
+        self.candidate_indexes={} # Candidate indexes of the catalogues used by the get_* functions
+        self.seed=seed # Run seed making macrocomponent choices reproducible. If None, choices are drawn with the random modules.
+        # Optional cache of results_one_building and material_amounts_one_building (disabled if cache_size is 0). The generation of the results
+        # is read from the database at most every generation_check seconds, so changes made by other processes are seen after that delay at most.
+        self.cache=result_cache(cache_size,cache_ttl) if cache_size>0 else None
+        self.generation_check=generation_check
+        self.generation_table=False # See results_generation
+        self.weights_checked=False # See ensure_weights
         self.get_perimeter_sql=f"SELECT (CASE WHEN (b.byg054AntalEtager IS NULL OR b.byg054AntalEtager = 0) THEN SQRT(b.byg041BebyggetAreal)*2*(%s+1/%s) ELSE SQRT(b.byg038SamletBygningsareal/b.byg054AntalEtager)*2*(%s+1/%s) END) as perimeter" % (space_efficiency,space_efficiency,space_efficiency,space_efficiency) #Rough approximation if the building has storeys of different sizes
+        # Quantity of each building part by which the amounts of products per unit are multiplied (same expressions as in the amounts_* functions).
+        # To be used as "FROM buildings b, LATERAL (get_perimeter_sql) ltp, LATERAL (geometry_sql) ltg".
+        self.geometry_sql="""SELECT
+            (CASE WHEN b.byg054AntalEtager IS NOT NULL THEN perimeter*b.byg054AntalEtager*%s*(1-%s) ELSE perimeter*%s*(1-%s) END) AS ext_wall_quantity,
+            (CASE WHEN b.byg054AntalEtager IS NOT NULL THEN perimeter*b.byg054AntalEtager*%s*%s ELSE perimeter*%s*%s END) AS window_quantity,
+            (b.int_wall_surface_nlb+b.int_wall_surface_lb) AS int_wall_quantity,
+            (CASE WHEN b.byg054AntalEtager IS NOT NULL THEN b.byg041BebyggetAreal*(b.byg054AntalEtager-1) ELSE 0 END) AS floor_quantity,
+            b.byg041BebyggetAreal AS foundation_quantity,
+            b.byg041BebyggetAreal AS ground_slab_quantity,
+            b.byg041BebyggetAreal/COS(b.roof_pitch*PI()*180) AS roof_cover_quantity,
+            b.byg041BebyggetAreal/COS(b.roof_pitch*PI()*180) AS roof_structure_quantity,
+            SQRT(b.byg041BebyggetAreal)*%s AS ridge_board_quantity""" % (default_floor_height,window_wall_ratio,default_floor_height,window_wall_ratio,
+                                                                          default_floor_height,window_wall_ratio,default_floor_height,window_wall_ratio,space_efficiency)
     
+    # Close all connections of the pool. The object can also be used as a context manager (with macrocomponent_database(...) as db:) to close the pool automatically.
+    def close(self):
+        self.pool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        self.close()
+
     # Generic function to run SQL queries
     def run_sql(self,SQLcode):
         connector=None
         try:
-            # connect to the PostgreSQL database
-            connector = pg.connect(self.db_params)
+            # borrow a connection from the pool
+            connector = self.pool.getconn()
 
             # create a new cursor
             cur = connector.cursor()
@@ -30,15 +1062,17 @@ class macrocomponent_database:
             # commit the changes to the database
             connector.commit()
 
-            # close communication with the database
+            # close the cursor, the connection is returned to the pool below
             cur.close()
+            return True
 
         except (Exception, pg.DatabaseError) as error:
             print('error: '+str(error))
+            return False
 
         finally:
             if connector is not None:
-                connector.close()
+                self.pool.putconn(connector)
 
     # Functions to insert BBR data into the database
     def insert_bbr_from_dict(self,row_dict):
@@ -95,538 +1129,522 @@ class macrocomponent_database:
                 # Reset the building dictionary to record values for the next building:
                 building_dict=dict()
 
-            elif param in bbr_parameters:
+            elif param in self.bbr_params:
                 # If the parameter we're reading is on the list of parameters we're interested in, record it.
                 building_dict[param]=value    
 
-    # Functions to query building properties and material amounts from the database
-    def properties_one_building(self,parameter_list,bbr_id):
-        dic={}
-        for p in parameter_list:
-            dic[p]=[]
-        index=[]
-        
-        SQL="SELECT "
-        for p in parameter_list:
-            SQL+=p+', '
-        SQL=SQL[0:len(SQL)-2]
-        SQL+=" FROM buildings WHERE id_lokalId=%s"
-        
+    # Functions to insert BBR data in bulk
+    # Instead of one INSERT (and one connection) per building, buildings are streamed in batches into a temporary staging table with COPY,
+    # and each batch is then merged into the buildings table with a single INSERT ... ON CONFLICT statement.
+    def copy_bbr_rows(self,connector,columns,rows):
+        cur=connector.cursor()
+        # The staging table has the same columns as the buildings table, but no primary key, and is emptied at the end of each transaction
+        cur.execute("CREATE TEMP TABLE IF NOT EXISTS buildings_staging (LIKE buildings INCLUDING DEFAULTS) ON COMMIT DELETE ROWS")
+
+        with cur.copy("COPY buildings_staging ("+', '.join(columns)+") FROM STDIN") as copy:
+            for row in rows:
+                copy.write_row(row)
+
+        # A building can appear more than once in the same batch (e.g. in a BBR delta file), in which case only the last occurrence is kept.
+        # Rows of a freshly filled temporary table are stored in the order they were copied, so the last occurrence has the highest ctid.
+        # Buildings whose values are unchanged are not updated, and the new or modified buildings are marked as dirty (see refresh_material_amounts)
+        self.create_dirty_table(cur)
+        sql="WITH upserted AS (INSERT INTO buildings("+', '.join(columns)+") "
+        sql+="SELECT DISTINCT ON (id_lokalId) "+', '.join(columns)+" FROM buildings_staging ORDER BY id_lokalId, ctid DESC "
+        sql+="ON CONFLICT ON CONSTRAINT buildings_pkey DO UPDATE SET ("+', '.join(columns)+") = ("+', '.join(['EXCLUDED.'+c for c in columns])+") "
+        sql+="WHERE ROW("+', '.join(['buildings.'+c for c in columns])+") IS DISTINCT FROM ROW("+', '.join(['EXCLUDED.'+c for c in columns])+") "
+        sql+="RETURNING id_lokalId) "
+        sql+="INSERT INTO buildings_dirty(bbr_id) SELECT id_lokalId FROM upserted ON CONFLICT DO NOTHING"
+        cur.execute(sql)
+
+        connector.commit()
+        cur.close()
+
+    # Change tracking: buildings inserted or modified by copy_bbr_rows are listed in the buildings_dirty table, so that refresh_material_amounts
+    # only recomputes these buildings instead of the whole stock. A refresh works on the buildings_refresh batch, into which it moves the dirty buildings.
+    def create_dirty_table(self,cur):
+        cur.execute("CREATE TABLE IF NOT EXISTS buildings_dirty (bbr_id character varying(50) PRIMARY KEY)")
+        cur.execute("CREATE TABLE IF NOT EXISTS buildings_refresh (bbr_id character varying(50) PRIMARY KEY)")
+
+    def mark_dirty(self,bbr_ids=None):
+        # Marks the given buildings (all buildings if bbr_ids is None) to be recomputed, e.g. after a change of the macrocomponents catalogue
         conn=None
-
         try:
-            conn = pg.connect(self.db_params, row_factory=pg.rows.dict_row)
+            conn = self.pool.getconn()
             cur=conn.cursor()
-            
-            cur.execute(SQL,(bbr_id,))
-            row=cur.fetchone()
-
-            while row is not None:
-                index.append(row['id_lokalid'])
-                for k in dic.keys():
-                    dic[k].append(row[k.lower()])
-                    
-                row=cur.fetchone()
-                
-            results=pd.DataFrame(dic,index)
-
+            self.create_dirty_table(cur)
+            if bbr_ids is None:
+                cur.execute("INSERT INTO buildings_dirty(bbr_id) SELECT id_lokalId FROM buildings ON CONFLICT DO NOTHING")
+            else:
+                cur.execute("INSERT INTO buildings_dirty(bbr_id) SELECT unnest(%s::varchar[]) ON CONFLICT DO NOTHING", (list(bbr_ids),))
             conn.commit()
             cur.close()
-            
-            return(results)
 
         except (Exception, pg.DatabaseError) as error:
-            print('error: '+str(error))
+            print(error)
         finally:
             if conn is not None:
-                conn.close()  
-
-    def properties_all_buildings(self,parameter_list):
-        dic={}
-        for p in parameter_list:
-            dic[p]=[]
-        index=[]
-        
-        SQL="SELECT "
-        for p in parameter_list:
-            SQL+=p+', '
-        SQL=SQL[0:len(SQL)-2]
-        SQL+=" FROM buildings"
-        
+                self.pool.putconn(conn)
+
+    def buildings_source(self,dirty_only=False):
+        # Table of buildings used in the queries, restricted to the buildings of the refresh batch if dirty_only is True
+        if dirty_only:
+            return "(SELECT * FROM buildings WHERE id_lokalId IN (SELECT bbr_id FROM buildings_refresh))"
+        return "buildings"
+
+    def refresh_material_amounts(self):
+        # Recomputes the roof pitch, internal walls, macrocomponents and material amounts of the dirty buildings only. Returns True if all steps succeeded.
+        # The dirty buildings are first moved to the buildings_refresh batch in a single statement, so that buildings marked during the refresh stay
+        # in buildings_dirty for the next one. The batch is only emptied once every step has succeeded, otherwise it is recomputed by the next refresh.
+        start=time.perf_counter()
         conn=None
-
         try:
-            conn = pg.connect(self.db_params, row_factory=pg.rows.dict_row)
+            conn = self.pool.getconn()
             cur=conn.cursor()
-            
-            cur.execute(SQL,(bbr_id,))
-            row=cur.fetchone()
-
-            while row is not None:
-                index.append(row['id_lokalid'])
-                for k in dic.keys():
-                    dic[k].append(row[k.lower()])
-                    
-                row=cur.fetchone()
-                
-            results=pd.DataFrame(dic,index)
-
+            self.create_dirty_table(cur)
+            cur.execute("WITH moved AS (DELETE FROM buildings_dirty RETURNING bbr_id) INSERT INTO buildings_refresh(bbr_id) SELECT bbr_id FROM moved ON CONFLICT DO NOTHING")
+            cur.execute("SELECT COUNT(*) FROM buildings_refresh")
+            n_dirty=cur.fetchone()[0]
             conn.commit()
             cur.close()
-            
-            return(results)
-
-        except (Exception, pg.DatabaseError) as error:
-            print('error: '+str(error))
         finally:
             if conn is not None:
-                conn.close() 
+                self.pool.putconn(conn)
+
+        succeeded=(self.parse_coordinates(dirty_only=True) and self.approx_roof_pitch(dirty_only=True)
+                   and self.estimate_lb_internal_walls(dirty_only=True) and self.estimate_nlb_internal_walls(dirty_only=True)
+                   and all(self.link_element(element,dirty_only=True) for element in linked_elements)
+                   and self.add_ridge_board(dirty_only=True) and self.add_top_floor_ceiling(dirty_only=True)
+                   and self.calculate_material_amounts(dirty_only=True))
+        if not succeeded:
+            print('refresh failed, the %s buildings will be recomputed by the next refresh' % n_dirty)
+            return False
+        self.run_sql("TRUNCATE buildings_refresh")
+        print('%s buildings refreshed in %.1f s' % (n_dirty, time.perf_counter()-start))
+        return True
+
+    def retrieve_values_bulk(self,jsonfile,batch_size=None):
+        # Same as retrieve_values, but buildings are inserted in batches of batch_size buildings using copy_bbr_rows
+        if batch_size is None:
+            batch_size=self.batch_size
+
+        columns=list(self.bbr_params) # Every building is written with the same columns, parameters missing from the JSON file are recorded as NULL
+        jsondata = open(jsonfile, encoding='utf8')
+        items = ijson.kvitems(jsondata, 'BygningList.item')
+        building_dict=dict()
+        batch=[]
+        n_buildings=0
+        start=time.perf_counter()
 
-    def results_one_building(self,bbr_id):
-        dic={'bbr_id':[],'element':[],'product':[],'weight':[],'material_type':[]}
-        
-        SQL="""
-        SELECT
-        rma.bbr_id bbr_id,
-        rma.element element,
-        rma.product product,
-        weight,
-        material_type
-        FROM results_material_amounts rma
-        INNER JOIN products pr ON rma.product=pr.name,
-        LATERAL (SELECT (CASE WHEN unit='KG' THEN amount WHEN unit='M3' THEN amount*pr.density ELSE NULL END) AS weight) lt
-        WHERE rma.bbr_id=%s
-        ORDER BY element  
-        """
-        
+        connector=None
         try:
-            conn = pg.connect(self.db_params, row_factory=pg.rows.dict_row)
-            cur=conn.cursor()
-            
-            cur.execute(SQL,(bbr_id,))
-            row=cur.fetchone()     
-                
-            while row is not None:
-                for k in dic.keys():
-                    dic[k].append(row[k.lower()])
+            connector = self.pool.getconn()
+
+            for param, value in items:
+                if param == 'forretningshændelse': # First parameter of each building in the JSON file
+                    if len(building_dict.values())>0:
+                        batch.append(tuple(building_dict.get(c) for c in columns))
+                    building_dict=dict()
+
+                    if len(batch)>=batch_size:
+                        self.copy_bbr_rows(connector,columns,batch)
+                        n_buildings+=len(batch)
+                        batch=[]
+                        clear_output(wait=True)
+                        print('%s buildings recorded, %.0f buildings/s' % (n_buildings, n_buildings/(time.perf_counter()-start)))
+
+                elif param in columns:
+                    building_dict[param]=value
+
+            # Record the last building and the last (incomplete) batch
+            if len(building_dict.values())>0:
+                batch.append(tuple(building_dict.get(c) for c in columns))
+            if len(batch)>0:
+                self.copy_bbr_rows(connector,columns,batch)
+                n_buildings+=len(batch)
+
+            elapsed=time.perf_counter()-start
+            print('%s buildings recorded in %.1f s, %.0f buildings/s' % (n_buildings, elapsed, n_buildings/elapsed if elapsed>0 else 0))
 
+        except (Exception, pg.DatabaseError) as error:
+            print('error after '+str(n_buildings)+' buildings: '+str(error))
+        finally:
+            jsondata.close()
+            if connector is not None:
+                self.pool.putconn(connector)
+
+    def read_bbr(self,path,file_format=None,batch_size=None,checkpoint_file=None):
+        # Records all buildings of a BBR file (JSON or XML), resuming from the checkpoint of a previous interrupted run if there is one (see bbr_reader)
+        bbr_reader(self,path,file_format=file_format,batch_size=batch_size,checkpoint_file=checkpoint_file).run()
+
+    # Generation counter of the results, stored in the database and bumped in the same transaction as every rewrite of the links or material amounts
+    def create_generation_table(self,cur):
+        cur.execute("CREATE TABLE IF NOT EXISTS results_generation (id smallint PRIMARY KEY, generation bigint NOT NULL)")
+
+    def bump_generation(self,cur):
+        # Returns the new generation, to be passed to cache_generation once the transaction is committed
+        self.create_generation_table(cur)
+        cur.execute("""INSERT INTO results_generation(id, generation) VALUES (1, 1)
+        ON CONFLICT (id) DO UPDATE SET generation = results_generation.generation+1 RETURNING generation""")
+        return cur.fetchone()[0]
+
+    def cache_generation(self,generation):
+        # Only called after the commit of the transaction that bumped the generation, so that the cache never stores results older than their generation
+        if self.cache is not None:
+            self.cache.set_generation(generation)
+
+    def results_generation(self):
+        # Read-only: the table is only created by bump_generation, and a database without it is at generation 0. Returns None on error.
+        conn=None
+        try:
+            conn = self.pool.getconn()
+            cur=conn.cursor()
+            row=None
+            if not self.generation_table:
+                cur.execute("SELECT to_regclass('results_generation') IS NOT NULL")
+                self.generation_table=cur.fetchone()[0] # The table is never dropped once created
+            if self.generation_table:
+                cur.execute("SELECT generation FROM results_generation WHERE id = 1")
                 row=cur.fetchone()
-                
-            results=pd.DataFrame(dic)
-            
             conn.commit()
             cur.close()
-            
-            return(results)
+            return 0 if row is None else row[0]
 
         except (Exception, pg.DatabaseError) as error:
             print(error)
         finally:
             if conn is not None:
-                conn.close() 
+                self.pool.putconn(conn)
+
+    def cached(self,query,bbr_id,lookup):
+        # Returns the cached result of lookup(bbr_id), or runs it and caches its result. Copies are returned so that callers cannot modify the cache.
+        if self.cache is None:
+            return lookup(bbr_id)
+        if time.monotonic()-self.cache.checked>=self.generation_check:
+            generation=self.results_generation()
+            if generation is None: # The generation is unknown, so the cache cannot be trusted
+                return lookup(bbr_id)
+            self.cache.set_generation(generation)
+        results=self.cache.get((query,bbr_id))
+        if results is None:
+            results=lookup(bbr_id)
+            if results is None: # Errors are not cached
+                return None
+            self.cache.put((query,bbr_id),results)
+        return results.copy()
 
-    def results_all_buildings(self):
-        dic={'bbr_id':[],'element':[],'product':[],'weight':[],'material_type':[]}
-        
-        SQL="""
-        SELECT
-        rma.bbr_id bbr_id,
-        rma.element element,
-        rma.product product,
-        weight,
-        material_type
-        FROM results_material_amounts rma
-        INNER JOIN products pr ON rma.product=pr.name,
-        LATERAL (SELECT (CASE WHEN unit='KG' THEN amount WHEN unit='M3' THEN amount*pr.density ELSE NULL END) AS weight) lt
-        ORDER BY bbr_id  
-        """
-        
-        try:
-            conn = pg.connect(self.db_params, row_factory=pg.rows.dict_row)
+    def cache_stats(self):
+        return None if self.cache is None else self.cache.stats()
+
+    # Functions to query building properties and material amounts from the database
+    def frame(self,conn,sql,params=None,categorical=(),fetch_size=None,server_side=True):
+        # Runs a query on conn and builds the DataFrame (see frame_builder). Whole-stock queries go through a server-side cursor, fetched in batches
+        # of fetch_size rows. Lookups of a few buildings (server_side=False) are fetched in a single round-trip, without declaring a cursor.
+        if fetch_size is None:
+            fetch_size=self.batch_size
+        if server_side:
+            cur=conn.cursor(name='fetch_frame')
+            cur.execute(sql,params)
+            rows=cur.fetchmany(fetch_size)
+            builder=frame_builder(cur.description,categorical)
+
+            while len(rows)>0:
+                builder.add(rows)
+                rows=cur.fetchmany(fetch_size)
+        else:
             cur=conn.cursor()
-            
-            cur.execute(SQL)
-            row=cur.fetchone()     
-                
-            while row is not None:
-                for k in dic.keys():
-                    dic[k].append(row[k.lower()])
+            cur.execute(sql,params)
+            builder=frame_builder(cur.description,categorical)
+            builder.add(cur.fetchall())
+        results=builder.frame()
+
+        conn.commit()
+        cur.close()
+
+        return(results)
+
+    def fetch_frame(self,sql,params=None,categorical=(),fetch_size=None,server_side=True):
+        conn=None
+        try:
+            conn = self.pool.getconn()
+            return self.frame(conn,sql,params,categorical,fetch_size,server_side)
+
+        finally:
+            if conn is not None:
+                self.pool.putconn(conn)
+
+    def iter_frames(self,sql,params=None,categorical=(),chunk_size=None,group=None):
+        # Generator version of fetch_frame, yielding one DataFrame per chunk of chunk_size rows (categories are set per chunk).
+        # If the query is ordered by the column group, rows with the same value of group (e.g. all results of a building) are never split between chunks.
+        # The connection is held until the generator is exhausted or closed.
+        if chunk_size is None:
+            chunk_size=self.batch_size
+        conn=None
+        try:
+            conn = self.pool.getconn()
+            cur=conn.cursor(name='iter_frames')
+            cur.execute(sql,params)
+            rows=cur.fetchmany(chunk_size)
+            names=[c.name for c in cur.description]
+            pending=[]
+
+            while len(rows)>0:
+                pending+=rows
+                rows=cur.fetchmany(chunk_size)
+                n=len(pending)
+                if group is not None and len(rows)>0: # Hold back the last group if it continues in the next batch
+                    g=names.index(group)
+                    while n>0 and pending[n-1][g]==rows[0][g]:
+                        n-=1
+                if n>0:
+                    builder=frame_builder(cur.description,categorical)
+                    builder.add(pending[:n])
+                    pending=pending[n:]
+                    yield builder.frame()
 
-                row=cur.fetchone()
-                
-            results=pd.DataFrame(dic)
-            
             conn.commit()
             cur.close()
-            
-            return(results)
 
-        except (Exception, pg.DatabaseError) as error:
-            print(error)
         finally:
             if conn is not None:
-                conn.close() 
+                self.pool.putconn(conn)
 
-    def material_amounts_one_building(self,bbr_id):
-        dic={'bbr_id':[],'clay':[],'cement_mortar':[],'concrete':[],'gypsum_plaster':[], 'metal':[],'wood':[],'wool':[],'glass':[],'other':[]}
-        index=[]
-        
-        SQL1="""
-        CREATE TEMP TABLE IF NOT EXISTS agg_material (
-            bbr_id varchar(50) PRIMARY KEY,
-            Clay real,
-            Cement_mortar real,
-            Concrete real,
-            Aggregates real,
-            Gypsum_plaster real,
-            Metal real,
-            Wood real,
-            Wool real,
-            Glass real,
-            Other real);"""
-        
-        SQL2="""
-        WITH t AS(
-        SELECT
-        rma.bbr_id,
-        weight,
-        material_type
-        FROM results_material_amounts rma
-        INNER JOIN products pr ON rma.product=pr.name,
-        LATERAL (SELECT (CASE WHEN unit='KG' THEN amount WHEN unit='M3' THEN amount*pr.density ELSE NULL END) AS weight) lt
-        WHERE rma.bbr_id=%s
-        )
 
-        SELECT
-        bbr_id,
-        SUM(weight) weightsum,
-        material_type
-        INTO TEMPORARY TABLE t2
-        FROM t
-        GROUP BY material_type, bbr_id;    
-        """
-
-        SQLclay="""
-        INSERT INTO agg_material(bbr_id, Clay)
-        SELECT 
-        bbr_id,
-        weightsum
-        FROM t2
-        WHERE material_type = 'Clay'
-        ON CONFLICT ON CONSTRAINT agg_material_pkey DO UPDATE SET (bbr_id, Clay) = (EXCLUDED.bbr_id, EXCLUDED.Clay);
-        """
-        
-        SQLcement="""
-        INSERT INTO agg_material(bbr_id, Cement_mortar)
-        SELECT 
-        bbr_id,
-        weightsum
-        FROM t2
-        WHERE material_type = 'Cement_mortar' 
-        ON CONFLICT ON CONSTRAINT agg_material_pkey DO UPDATE SET (bbr_id, Cement_mortar) = (EXCLUDED.bbr_id, EXCLUDED.Cement_mortar);
-        """
-
-        SQLconcrete="""
-        INSERT INTO agg_material(bbr_id, Concrete)
-        SELECT 
-        bbr_id,
-        weightsum
-        FROM t2
-        WHERE material_type = 'Concrete'
-        ON CONFLICT ON CONSTRAINT agg_material_pkey DO UPDATE SET (bbr_id, Concrete) = (EXCLUDED.bbr_id, EXCLUDED.Concrete);
-        """
-        
-        SQLaggregates="""
-        INSERT INTO agg_material(bbr_id, Aggregates)
-        SELECT 
-        bbr_id,
-        weightsum
-        FROM t2
-        WHERE material_type = 'Aggregates'
-        ON CONFLICT ON CONSTRAINT agg_material_pkey DO UPDATE SET (bbr_id, Aggregates) = (EXCLUDED.bbr_id, EXCLUDED.Aggregates);
-        """
-
-        SQLgypsum="""
-        INSERT INTO agg_material(bbr_id, Gypsum_plaster)
-        SELECT 
-        bbr_id,
-        weightsum
-        FROM t2
-        WHERE material_type = 'Gypsum_plaster'
-        ON CONFLICT ON CONSTRAINT agg_material_pkey DO UPDATE SET (bbr_id, Gypsum_plaster) = (EXCLUDED.bbr_id, EXCLUDED.Gypsum_plaster);
-        """
-
-        SQLmetal="""
-        INSERT INTO agg_material(bbr_id, Metal)
-        SELECT 
-        bbr_id,
-        weightsum
-        FROM t2
-        WHERE material_type = 'Metal'
-        ON CONFLICT ON CONSTRAINT agg_material_pkey DO UPDATE SET (bbr_id, Metal) = (EXCLUDED.bbr_id, EXCLUDED.Metal);
-        """
-
-        SQLwood="""
-        INSERT INTO agg_material(bbr_id, Wood)
-        SELECT 
-        bbr_id,
-        weightsum
-        FROM t2
-        WHERE material_type = 'Wood'
-        ON CONFLICT ON CONSTRAINT agg_material_pkey DO UPDATE SET (bbr_id, Wood) = (EXCLUDED.bbr_id, EXCLUDED.Wood);
-        """
-
-        SQLwool="""
-        INSERT INTO agg_material(bbr_id, Wool)
-        SELECT 
-        bbr_id,
-        weightsum
-        FROM t2
-        WHERE material_type = 'Wool'
-        ON CONFLICT ON CONSTRAINT agg_material_pkey DO UPDATE SET (bbr_id, Wool) = (EXCLUDED.bbr_id, EXCLUDED.Wool);
-        """
-        
-        SQLglass="""
-        INSERT INTO agg_material(bbr_id, Glass)
-        SELECT 
-        bbr_id,
-        weightsum
-        FROM t2
-        WHERE material_type = 'Glass'
-        ON CONFLICT ON CONSTRAINT agg_material_pkey DO UPDATE SET (bbr_id, Glass) = (EXCLUDED.bbr_id, EXCLUDED.Glass);
-        """
-
-        SQLother="""
-        INSERT INTO agg_material(bbr_id, Other)
-        SELECT 
-        bbr_id,
-        weightsum
-        FROM t2
-        WHERE material_type = 'Other'
-        ON CONFLICT ON CONSTRAINT agg_material_pkey DO UPDATE SET (bbr_id, Other) = (EXCLUDED.bbr_id, EXCLUDED.Other);
-        """
-
-        SQLselect="SELECT * FROM agg_material"
-        
+    def properties_frame(self,parameter_list,where='',params=None,server_side=True):
         try:
-            conn = pg.connect(self.db_params, row_factory=pg.rows.dict_row)
-            cur=conn.cursor()
-            
-            cur.execute(SQL1)
-            cur.execute(SQL2,(bbr_id,))
-            cur.execute(SQLclay)
-            cur.execute(SQLcement)
-            cur.execute(SQLconcrete)
-            cur.execute(SQLaggregates)
-            cur.execute(SQLgypsum)
-            cur.execute(SQLmetal)
-            cur.execute(SQLwood)
-            cur.execute(SQLwool)
-            cur.execute(SQLglass)
-            cur.execute(SQLother)
-            cur.execute(SQLselect)       
-
-            row=cur.fetchone()
-            
-            while row is not None:
-                index.append(row['bbr_id'])
-                for k in dic.keys():
-                    dic[k].append(row[k.lower()])
+            results=self.fetch_frame(properties_sql(parameter_list,where),params,server_side=server_side)
+            return properties_index(results,parameter_list)
 
-                row=cur.fetchone()
-                
-            results=pd.DataFrame(dic,index)
+        except (Exception, pg.DatabaseError) as error:
+            print('error: '+str(error))
+
+    def properties_buildings(self,parameter_list,bbr_ids):
+        # Properties of several buildings (list or array of ids) in a single query, indexed by building id
+        return self.properties_frame(parameter_list,"WHERE id_lokalId = ANY(%s)",([str(b) for b in bbr_ids],),server_side=False)
+
+    def properties_one_building(self,parameter_list,bbr_id):
+        return self.properties_buildings(parameter_list,[bbr_id])
+
+    def properties_all_buildings(self,parameter_list):
+        return self.properties_frame(parameter_list)
+
+    def properties_all_buildings_chunks(self,parameter_list,chunk_size=None):
+        # Same as properties_all_buildings, but yields the buildings in chunks of chunk_size buildings ordered by id
+        for results in self.iter_frames(properties_sql(parameter_list,order=" ORDER BY id_lokalId"),chunk_size=chunk_size):
+            yield properties_index(results,parameter_list)
+
+    def results_frame(self,where='',params=None,order='bbr_id',server_side=True):
+        try:
+            self.ensure_weights()
+            return self.fetch_frame(results_sql(where,order),params,categorical=result_categories,server_side=server_side)
+
+        except (Exception, pg.DatabaseError) as error:
+            print(error)
+
+    def results_buildings(self,bbr_ids):
+        # Results of several buildings (list or array of ids) in a single query, indexed by building id
+        results=self.results_frame("WHERE rw.bbr_id = ANY(%s)",([str(b) for b in bbr_ids],),order='bbr_id, element',server_side=False)
+        if results is not None:
+            results.index=results['bbr_id'].tolist()
+        return results
+
+    def results_one_building(self,bbr_id):
+        return self.cached('results',bbr_id,self.lookup_results_one_building)
+
+    def lookup_results_one_building(self,bbr_id):
+        results=self.results_buildings([bbr_id])
+        if results is not None:
+            results=results.reset_index(drop=True)
+        return results
+
+    def results_all_buildings(self):
+        return self.results_frame()
+
+    def results_all_buildings_chunks(self,chunk_size=None):
+        # Same as results_all_buildings, but yields the results in chunks of about chunk_size rows ordered by bbr_id. The results of a building are never split between two chunks.
+        self.ensure_weights()
+        return self.iter_frames(results_sql(),categorical=result_categories,chunk_size=chunk_size,group='bbr_id')
+
+    def material_amounts_buildings(self,bbr_ids):
+        # Material amounts of several buildings (list or array of ids) in a single query, indexed by building id
+        return self.material_amounts_frame("WHERE rw.bbr_id = ANY(%s)",([str(b) for b in bbr_ids],),server_side=False)
+
+    def material_amounts_one_building(self,bbr_id):
+        return self.cached('material_amounts',bbr_id,lambda b: self.material_amounts_buildings([b]))
+
+    def material_amounts_frame(self,where='',params=(),server_side=True):
+        conn=None
+        try:
+            self.ensure_weights()
+            # The material types and the amounts are read on the same connection
+            conn = self.pool.getconn()
+            materials=self.material_types(conn.cursor())
+            results=self.frame(conn,material_amounts_sql(materials,where),tuple(materials)+tuple(params),server_side=server_side)
+            results.columns=['bbr_id']+material_columns(materials)
+            results.index=results['bbr_id'].tolist()
 
-            conn.commit()
-            cur.close()
-            
             return(results)
 
         except (Exception, pg.DatabaseError) as error:
             print(error)
         finally:
             if conn is not None:
-                conn.close() 
+                self.pool.putconn(conn)
 
     def material_amounts_all(self):
-        dic={'bbr_id':[],'clay':[],'cement_mortar':[],'concrete':[],'gypsum_plaster':[], 'metal':[],'wood':[],'wool':[],'other':[]}
-        index=[]
-        
-        SQL1="""
-        CREATE TEMP TABLE IF NOT EXISTS agg_material (
-            bbr_id varchar(50) PRIMARY KEY,
-            Clay real,
-            Cement_mortar real,
-            Concrete real,
-            Aggregates real,
-            Gypsum_plaster real,
-            Metal real,
-            Wood real,
-            Wool real,
-            Glass real,
-            Other real);"""
-        
-        SQL2="""
-        WITH t AS(
-        SELECT
-        rma.bbr_id,
-        weight,
-        material_type
-        FROM results_material_amounts rma
-        INNER JOIN products pr ON rma.product=pr.name,
-        LATERAL (SELECT (CASE WHEN unit='KG' THEN amount WHEN unit='M3' THEN amount*pr.density ELSE NULL END) AS weight) lt
-        )
+        return self.material_amounts_frame()
+
+    # Spatial queries
+    def parse_coordinates(self,dirty_only=False):
+        # Parses byg404Koordinat ("POINT(x y)") into coord_x and coord_y, and indexes the buildings by grid cell (see grid_size)
+        sql="""
+        UPDATE buildings b
+        SET coord_x = pt[1]::double precision, coord_y = pt[2]::double precision,
+        grid_cell = floor(pt[1]::double precision/%s)::bigint*%s + floor(pt[2]::double precision/%s)::bigint
+        FROM (SELECT id_lokalId, regexp_match(byg404Koordinat, 'POINT\\s*\\(\\s*([-+0-9.eE]+)\\s+([-+0-9.eE]+)') AS pt FROM %s b) p
+        WHERE p.id_lokalId = b.id_lokalId
+        """ % (grid_size,grid_rows,grid_size,self.buildings_source(dirty_only))
+        conn=None
+        try:
+            conn = self.pool.getconn()
+            cur=conn.cursor()
+            # The columns and their index are only added once: ALTER TABLE and CREATE INDEX lock the table even when there is nothing to do
+            cur.execute("SELECT COUNT(*) FROM information_schema.columns WHERE table_schema = current_schema() AND table_name = 'buildings' AND column_name = 'grid_cell'")
+            if cur.fetchone()[0]==0:
+                cur.execute("ALTER TABLE buildings ADD COLUMN IF NOT EXISTS coord_x double precision, ADD COLUMN IF NOT EXISTS coord_y double precision, ADD COLUMN IF NOT EXISTS grid_cell bigint")
+                cur.execute("CREATE INDEX IF NOT EXISTS buildings_grid_cell ON buildings (grid_cell)")
+            cur.execute(sql)
+            conn.commit()
+            if not dirty_only: # A few updated buildings do not change the statistics of the table
+                cur.execute("ANALYZE buildings")
+                conn.commit()
+            cur.close()
+            return True
+
+        except (Exception, pg.DatabaseError) as error:
+            print(error)
+            return False
+        finally:
+            if conn is not None:
+                self.pool.putconn(conn)
 
+    def material_stock_area(self,xmin,ymin,xmax,ymax,condition='',params=()):
+        # Total weight (in kg) of each material type of each building part for the buildings within the box, and within condition if given.
+        # Only the grid cells overlapping the box are scanned: one range of the grid_cell index for each column of the grid.
+        sql="""
         SELECT
-        bbr_id,
-        SUM(weight) weightsum,
-        material_type
-        INTO TEMPORARY TABLE t2
-        FROM t
-        GROUP BY material_type, bbr_id;    
-        """
-
-        SQLclay="""
-        INSERT INTO agg_material(bbr_id, Clay)
-        SELECT 
-        bbr_id,
-        weightsum
-        FROM t2
-        WHERE material_type = 'Clay'
-        ON CONFLICT ON CONSTRAINT agg_material_pkey DO UPDATE SET (bbr_id, Clay) = (EXCLUDED.bbr_id, EXCLUDED.Clay);
-        """
-        
-        SQLcement="""
-        INSERT INTO agg_material(bbr_id, Cement_mortar)
-        SELECT 
-        bbr_id,
-        weightsum
-        FROM t2
-        WHERE material_type = 'Cement_mortar' 
-        ON CONFLICT ON CONSTRAINT agg_material_pkey DO UPDATE SET (bbr_id, Cement_mortar) = (EXCLUDED.bbr_id, EXCLUDED.Cement_mortar);
-        """
-
-        SQLconcrete="""
-        INSERT INTO agg_material(bbr_id, Concrete)
-        SELECT 
-        bbr_id,
-        weightsum
-        FROM t2
-        WHERE material_type = 'Concrete'
-        ON CONFLICT ON CONSTRAINT agg_material_pkey DO UPDATE SET (bbr_id, Concrete) = (EXCLUDED.bbr_id, EXCLUDED.Concrete);
-        """
-        
-        SQLaggregates="""
-        INSERT INTO agg_material(bbr_id, Aggregates)
-        SELECT 
-        bbr_id,
-        weightsum
-        FROM t2
-        WHERE material_type = 'Aggregates'
-        ON CONFLICT ON CONSTRAINT agg_material_pkey DO UPDATE SET (bbr_id, Aggregates) = (EXCLUDED.bbr_id, EXCLUDED.Aggregates);
-        """
-
-        SQLgypsum="""
-        INSERT INTO agg_material(bbr_id, Gypsum_plaster)
-        SELECT 
-        bbr_id,
-        weightsum
-        FROM t2
-        WHERE material_type = 'Gypsum_plaster'
-        ON CONFLICT ON CONSTRAINT agg_material_pkey DO UPDATE SET (bbr_id, Gypsum_plaster) = (EXCLUDED.bbr_id, EXCLUDED.Gypsum_plaster);
-        """
-
-        SQLmetal="""
-        INSERT INTO agg_material(bbr_id, Metal)
-        SELECT 
-        bbr_id,
-        weightsum
-        FROM t2
-        WHERE material_type = 'Metal'
-        ON CONFLICT ON CONSTRAINT agg_material_pkey DO UPDATE SET (bbr_id, Metal) = (EXCLUDED.bbr_id, EXCLUDED.Metal);
-        """
-
-        SQLwood="""
-        INSERT INTO agg_material(bbr_id, Wood)
-        SELECT 
-        bbr_id,
-        weightsum
-        FROM t2
-        WHERE material_type = 'Wood'
-        ON CONFLICT ON CONSTRAINT agg_material_pkey DO UPDATE SET (bbr_id, Wood) = (EXCLUDED.bbr_id, EXCLUDED.Wood);
-        """
-
-        SQLwool="""
-        INSERT INTO agg_material(bbr_id, Wool)
-        SELECT 
-        bbr_id,
-        weightsum
-        FROM t2
-        WHERE material_type = 'Wool'
-        ON CONFLICT ON CONSTRAINT agg_material_pkey DO UPDATE SET (bbr_id, Wool) = (EXCLUDED.bbr_id, EXCLUDED.Wool);
-        """
-        
-        SQLglass="""
-        INSERT INTO agg_material(bbr_id, Glass)
-        SELECT 
-        bbr_id,
-        weightsum
-        FROM t2
-        WHERE material_type = 'Glass'
-        ON CONFLICT ON CONSTRAINT agg_material_pkey DO UPDATE SET (bbr_id, Glass) = (EXCLUDED.bbr_id, EXCLUDED.Glass);
-        """
-
-        SQLother="""
-        INSERT INTO agg_material(bbr_id, Other)
-        SELECT 
-        bbr_id,
-        weightsum
-        FROM t2
-        WHERE material_type = 'Other'
-        ON CONFLICT ON CONSTRAINT agg_material_pkey DO UPDATE SET (bbr_id, Other) = (EXCLUDED.bbr_id, EXCLUDED.Other);
-        """
-
-        SQLselect="SELECT * FROM agg_material"
-        
+        rw.element element,
+        rw.material_type material_type,
+        SUM(rw.weight) weight,
+        COUNT(DISTINCT b.id_lokalId) buildings
+        FROM generate_series(floor(%%s/%s)::bigint, floor(%%s/%s)::bigint) gx
+        INNER JOIN buildings b
+            ON b.grid_cell BETWEEN gx*%s+floor(%%s/%s)::bigint AND gx*%s+floor(%%s/%s)::bigint
+        INNER JOIN results_weights rw ON rw.bbr_id = b.id_lokalId
+        WHERE b.coord_x BETWEEN %%s AND %%s AND b.coord_y BETWEEN %%s AND %%s %s
+        GROUP BY rw.element, rw.material_type
+        ORDER BY rw.element, rw.material_type
+        """ % (grid_size,grid_size,grid_rows,grid_size,grid_rows,grid_size,condition)
         try:
-            conn = pg.connect(self.db_params, row_factory=pg.rows.dict_row)
-            cur=conn.cursor()
-            
-            cur.execute(SQL1)
-            cur.execute(SQL2)
-            cur.execute(SQLclay)
-            cur.execute(SQLcement)
-            cur.execute(SQLconcrete)
-            cur.execute(SQLaggregates)
-            cur.execute(SQLgypsum)
-            cur.execute(SQLmetal)
-            cur.execute(SQLwood)
-            cur.execute(SQLwool)
-            cur.execute(SQLglass)
-            cur.execute(SQLother)
-            cur.execute(SQLselect)       
-
-            row=cur.fetchone()
-            
-            while row is not None:
-                index.append(row['bbr_id'])
-                for k in dic.keys():
-                    dic[k].append(row[k.lower()])
+            self.ensure_weights()
+            # Run with a server-side cursor, which is planned for fast start: the plan of a plain query may join every building to every column of a large box
+            return self.fetch_frame(sql,(xmin,xmax,ymin,ymax,xmin,xmax,ymin,ymax)+tuple(params),categorical=('element','material_type'))
 
-                row=cur.fetchone()
+        except (Exception, pg.DatabaseError) as error:
+            print(error)
 
-            results=pd.DataFrame(dic,index)
-                
-            conn.commit()
+    def material_stock_bbox(self,xmin,ymin,xmax,ymax):
+        return self.material_stock_area(xmin,ymin,xmax,ymax)
+
+    def material_stock_radius(self,x,y,radius):
+        # Material stock of the buildings within radius (in metres) of the point (x, y), e.g. around a demolition site
+        return self.material_stock_area(x-radius,y-radius,x+radius,y+radius,"AND (b.coord_x-%s)^2+(b.coord_y-%s)^2 <= %s^2",(x,y,radius))
+
+    # Export of the modelled stock to Parquet files
+    def export_parquet(self,directory,batch_size=None,tables=None):
+        # Writes the buildings, the mapping tables and the material results (in kg, from results_weights) to one Parquet dataset per table in directory,
+        # partitioned by municipality (directory/table/kommunekode=101/part-0.parquet, readable with pyarrow.parquet.read_table(..., memory_map=True)).
+        # Each table is streamed with a binary COPY sorted by municipality and written batch_size rows at a time, so it is never held in memory.
+        # pyarrow is only needed for this function.
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            print('pyarrow is required to export Parquet files')
+            return
+        if batch_size is None:
+            batch_size=self.batch_size
+        queries={'buildings':"SELECT * FROM buildings b"}
+        for spec in linked_elements.values():
+            queries[spec['mapping']]="SELECT m.*, b.kommunekode FROM "+spec['mapping']+" m INNER JOIN buildings b ON b.id_lokalId = m.bbr_id"
+        queries['results_weights']="SELECT rw.*, b.kommunekode FROM results_weights rw INNER JOIN buildings b ON b.id_lokalId = rw.bbr_id"
+        if tables is None:
+            tables=list(queries)
+
+        conn=None
+        try:
+            if 'results_weights' in tables:
+                self.ensure_weights()
+            conn = self.pool.getconn()
+            cur=conn.cursor()
+            start=time.perf_counter()
+            for table in tables:
+                sql=queries[table]+" ORDER BY b.kommunekode"
+                cur.execute(sql+" LIMIT 0") # Column names and types
+                names=[c.name for c in cur.description]
+                oids=[c.type_code for c in cur.description]
+                k=names.index('kommunekode')
+                # The municipality is stored in the directory names rather than in the files
+                columns=[n for n in range(len(names)) if n!=k]
+                schema=pa.schema([(names[n],getattr(pa,arrow_types[oids[n]])() if oids[n] in arrow_types else pa.string()) for n in columns])
+                os.makedirs(os.path.join(directory,table)) # Fails rather than mixing with the files of a previous export
+
+                writer=None
+                partition=None
+                batch=[]
+                n_rows=0
+
+                def write(rows):
+                    arrays=[]
+                    for n,field in zip(columns,schema):
+                        values=[r[n] for r in rows]
+                        if oids[n]==1700 or (oids[n] not in arrow_types):
+                            values=[None if v is None else (float(v) if oids[n]==1700 else str(v)) for v in values]
+                        arrays.append(pa.array(values,type=field.type))
+                    writer.write_batch(pa.RecordBatch.from_arrays(arrays,schema=schema))
+
+                with cur.copy("COPY ("+sql+") TO STDOUT (FORMAT BINARY)") as copy:
+                    copy.set_types(oids)
+                    for row in copy.rows():
+                        if writer is None or row[k]!=partition:
+                            if batch:
+                                write(batch)
+                                batch=[]
+                            if writer is not None:
+                                writer.close()
+                            partition=row[k]
+                            path=os.path.join(directory,table,'kommunekode='+('__HIVE_DEFAULT_PARTITION__' if partition is None else str(partition)))
+                            os.makedirs(path,exist_ok=True)
+                            writer=pq.ParquetWriter(os.path.join(path,'part-0.parquet'),schema)
+                        batch.append(row)
+                        n_rows+=1
+                        if len(batch)>=batch_size:
+                            write(batch)
+                            batch=[]
+                if batch:
+                    write(batch)
+                if writer is not None:
+                    writer.close()
+                conn.commit()
+                clear_output(wait=True)
+                print('%s: %s rows exported, %.1f s' % (table, n_rows, time.perf_counter()-start))
             cur.close()
-            
-            return(results)
 
         except (Exception, pg.DatabaseError) as error:
             print(error)
         finally:
             if conn is not None:
-                conn.close() 
+                self.pool.putconn(conn)
 
     # Functions to associate buildings with macrocomponents
     def random_possible_element (self, elem_list, id_list, construction_year): 
@@ -634,373 +1652,592 @@ class macrocomponent_database:
         # elem_list is the list of all  macrocomponents for one particular building part (e.g. external walls). It is a list of tuples that will later be retrieved from the database.
         # The first element of each tuple is the macrocomponent id and the 3rd and 4th are min and max years of use for this component.
         # id_list is the list of element ids for possible elements. We can narrow down the list of possible elements based on information from BBR regarding facade and roof cover.
-        
         if construction_year == None:
             return None
+        choices=possible_elements(elem_list,set(id_list),construction_year)
+        if len(choices)!=0:
+            return rd.choice(choices)
         else:
-            valid_choices=[] # list of macrocomponents where the building's construction year is between the component's min and max years of use.
-            early_choices=[] # list of macrocomponents where the building's construction year is before the component's min year
-            late_choices=[]  # list of macrocomponents where the building's construction year is after the component's max year
-            
-            for elem in elem_list:
-                elem_id=elem[0]
-                min_year=elem[2]
-                max_year=elem[3]
-                if elem_id in id_list and min_year<=construction_year<=max_year:
-                    valid_choices.append(elem)
-                elif elem_id in id_list and max_year<construction_year:
-                    late_choices.append(elem)
-                elif elem_id in id_list and construction_year<min_year:
-                    early_choices.append(elem)
-                    
-            if len(valid_choices)!=0:
-                random_solution = rd.choice(valid_choices)   # if there are valid choices, pick one of them
-                return random_solution 
-            elif len(late_choices)!=0:
-                random_solution = rd.choice(late_choices)    # otherwise, return one of the late choices if any
-                return random_solution
-            elif len(early_choices)!=0:
-                random_solution = rd.choice(early_choices)   # otherwise, return one of the early choices if any
-                return random_solution
-            else:
-                print('no valid choice')
-                return None
-            
-    def get_ext_wall(self, elems, bbr_material, cyear): 
-        valid_elements = []
-        for e in elems:
-            if bbr_material in e[-1]:
-                valid_elements.append(e[0]) # Make a list of all wall types that fit the BBR code
-        return self.random_possible_element(elems,valid_elements,cyear) # Pick one of these at random
+            print('no valid choice')
+            return None
 
-    def link_ext_walls(self):
-        conn=None
-        try:
-            conn = pg.connect(self.db_params)
-            cur_elem=conn.cursor()
-            cur_elem.execute("SELECT * FROM ext_wall_types ORDER BY id")
-            elems = cur_elem.fetchall() # Retrieve the list of all external wall types, which can be fed to the random choice function
-            # Make sure that bbr_material_id is the last column of the ext_walls table in the database - if not, adjust the SQL query to make sure that it returns a row where bbr_material_id is the last item
-            
-            cur = conn.cursor()
-            cur.execute("DELETE FROM buildings_to_ext_walls")
-            cur.execute("SELECT id_lokalid, byg032ydervæggensmateriale, byg026opførelsesår, byg021bygningensanvendelse FROM buildings")
-            row = cur.fetchone() # Get properties from the first building as a tuple
-                
-            cur_write=conn.cursor()
-            row_number=0
+    def get_candidate_index(self,elems,criterion):
+        # Returns the candidate index of a catalogue, building it the first time this catalogue (list object) is used
+        index=self.candidate_indexes.get((id(elems),criterion))
+        if index is None or index.elems is not elems:
+            index=candidate_index(elems,criterion)
+            self.candidate_indexes[(id(elems),criterion)]=index
+        return index
+
+    def get_draw(self,element,bbr_id):
+        # Seeded draw for one building, if the run is seeded and the building id is given
+        if self.seed is None or bbr_id is None:
+            return None
+        return building_draw(self.seed,element,bbr_id)
 
-            while row is not None:
-                row_number+=1
-                clear_output(wait=True)
-                print(row_number)
-                bbr_material=row[1] # Get reported wall material for the building
-                cyear=row[2] # Get the building's construction year
-                ext_wall=self.get_ext_wall(elems, bbr_material, cyear) # Pick a suitable type of external wall for the building
-                if ext_wall is not None:
-                    # Add entry to the mapping table
-                    cur_write.execute("INSERT INTO buildings_to_ext_walls(bbr_id, ext_wall_id) VALUES (%s, %s)", (row[0], ext_wall[0]))
-                else:
-                    # If there is no valid choice, add NULL to the mapping table
-                    cur_write.execute("INSERT INTO buildings_to_ext_walls(bbr_id) VALUES (%s)", (row[0],))
-                
-                row=cur.fetchone() # Retrieve the next building as a tuple and iterate
+    def get_draws(self,element,bbr_ids):
+        # Seeded draws for a list of buildings, or unseeded ones if the run is not seeded
+        if self.seed is None:
+            return np.random.default_rng().random(len(bbr_ids)) # Fresh generator, so that forked workers do not share the same random state
+        return building_draws(self.seed,element,bbr_ids)
 
-            conn.commit()
-            cur_write.close()
-            cur_elem.close()
-            cur.close()
+    def get_ext_wall(self, elems, bbr_material, cyear, bbr_id=None): 
+        return self.get_candidate_index(elems,'material').choose(bbr_material,cyear,self.get_draw('ext_wall',bbr_id)) # Pick one of the wall types that fit the BBR code at random
 
-        except (Exception, pg.DatabaseError) as error:
-            print('row number'+str(row_number)+'error: ')
-            print(error)
-        finally:
-            if conn is not None:
-                conn.close()
+    def link_ext_walls(self):
+        self.link_element('ext_wall')
 
-    def get_roof_cover(self, elems, bbr_material, cyear): # No category for shingles in BBR?
-        valid_elements = []
-        for e in elems:
-            if bbr_material in e[-1]:
-                valid_elements.append(e[0])
-        return self.random_possible_element(elems,valid_elements,cyear)
+    def get_roof_cover(self, elems, bbr_material, cyear, bbr_id=None): # No category for shingles in BBR?
+        return self.get_candidate_index(elems,'material').choose(bbr_material,cyear,self.get_draw('roof_cover',bbr_id))
 
     def link_roof_cover(self):
+        self.link_element('roof_cover')
+
+    def approx_roof_pitch(self,pitches=None,default_pitch=None,dirty_only=False):
+        # Depending on the type of roof cover material, the roof pitch is estimated for all buildings in a single statement.
+        # pitches (material -> pitch) and default_pitch replace roof_pitches and default_roof_pitch, e.g. for sensitivity studies.
+        if pitches is None:
+            pitches=roof_pitches
+        if default_pitch is None:
+            default_pitch=default_roof_pitch
+        values=', '.join(['(%s, %s)' % (int(material),int(pitch)) for material,pitch in pitches.items()]) or '(NULL::int, NULL::int)'
+        sql="""
+        UPDATE buildings b
+        SET roof_pitch = COALESCE((SELECT pm.pitch FROM (VALUES %s) pm(material, pitch) WHERE pm.material = b.byg033tagdækningsmateriale), %s)
+        """ % (values,int(default_pitch))
+        if dirty_only:
+            sql+="WHERE b.id_lokalId IN (SELECT bbr_id FROM buildings_refresh)"
+        return self.run_sql(sql)
+
+    def get_roof_structure(self, elems, cyear, pitch, bbr_id=None): #This function selects all roof structure types that can be used with the building's roof pitch, then selects a random one based on construction year.
+        return self.get_candidate_index(elems,'pitch').choose(pitch,cyear,self.get_draw('roof_structure',bbr_id))
+
+    def link_roof_structure(self):
+        self.link_element('roof_structure')
+
+    def add_ridge_board(self,dirty_only=False):
+        # Flat roofs do not have a ridge board, so it is added to all buildings that don't have a flat roof.
+        sql="""
+        INSERT INTO buildings_to_roof_structures(bbr_id, roof_structure_id)
+        SELECT b.id_lokalid, elem.id
+        FROM %s b
+        INNER JOIN buildings_to_roof_structures btt ON b.id_lokalid=btt.bbr_id
+        INNER JOIN roof_structure_types typ ON typ.id=btt.roof_structure_id,
+        (SELECT id FROM roof_structure_types WHERE name = 'Ridge board') elem
+        WHERE typ.name NOT LIKE 'Flat%%'
+        """ % self.buildings_source(dirty_only)
+        return self.run_sql(sql)
+
+    def add_top_floor_ceiling(self,dirty_only=False):
+        # Flat roofs are assumed not to have additional beams on the top floor ceiling, so it is added to all buildings that don't have a flat roof.
+        sql="""
+        INSERT INTO buildings_to_roof_structures(bbr_id, roof_structure_id)
+        SELECT b.id_lokalid, elem.id
+        FROM %s b
+        INNER JOIN buildings_to_roof_structures btt ON b.id_lokalid=btt.bbr_id
+        INNER JOIN roof_structure_types typ ON typ.id=btt.roof_structure_id,
+        (SELECT id FROM roof_structure_types WHERE name = 'Top floor ceiling') elem
+        WHERE typ.name NOT IN ('Ridge board', 'Flat wood', 'Flat concrete')
+        """ % self.buildings_source(dirty_only)
+        return self.run_sql(sql)
+
+    def get_floor(self, elems, cyear, bbr_id=None): # This function just selects a random appropriate component given the building's construction year
+        return self.get_candidate_index(elems,None).choose(None,cyear,self.get_draw('floor',bbr_id))
+
+    def get_int_wall(self,elems, cyear, bbr_id=None):
+        return self.get_candidate_index(elems,None).choose(None,cyear,self.get_draw('int_wall',bbr_id))
+
+    def get_ground_slab(self,elems, cyear, bbr_id=None):
+        return self.get_candidate_index(elems,None).choose(None,cyear,self.get_draw('ground_slab',bbr_id))
+
+    def get_foundation(self,elems, cyear, bbr_id=None):
+        return self.get_candidate_index(elems,None).choose(None,cyear,self.get_draw('foundation',bbr_id))
+
+    def get_element(self,element,elems,cyear,**kwargs): # Calls the function to select one particular type of element
+        var=eval("self.get_"+element)(elems, cyear, **kwargs)
+        return var
+
+    def link_other_element(self,element):
+        self.link_element(element)
+
+    # Vectorized assignment of macrocomponents
+    # The functions above pick a macrocomponent for one building at a time. The functions below do the same for all buildings at once:
+    # building properties are loaded into arrays, the candidates of each distinct (key, construction year) combination are resolved with a candidate_index,
+    # and one random choice per building is drawn in batch.
+    missing=np.iinfo(np.int64).min # Stands for NULL in the integer arrays of building properties
+
+    def load_types(self,cur,element):
+        spec=linked_elements[element]
+        sql="SELECT * FROM "+spec['types']
+        if 'types_filter' in spec:
+            sql+=" WHERE "+spec['types_filter']
+        cur.execute(sql+" ORDER BY id")
+        return cur.fetchall()
+
+    def load_buildings(self,cur,element,where=None,params=None):
+        # where is an optional SQL condition (with its parameters) restricting the buildings to load
+        spec=linked_elements[element]
+        key_column=spec['bbr_column'] if spec['criterion'] is not None else 'NULL'
+        sql="SELECT id_lokalid, byg026opførelsesår, "+key_column+" FROM buildings"
+        if where is not None:
+            sql+=" WHERE "+where
+        cur.execute(sql,params)
+        rows=cur.fetchall()
+
+        bbr_ids=[r[0] for r in rows]
+        years=np.array([self.missing if r[1] is None else r[1] for r in rows],dtype=np.int64)
+        keys=np.array([self.missing if r[2] is None else r[2] for r in rows],dtype=np.int64)
+        return bbr_ids, years, keys
+
+    def candidate_table(self,index,keys,years):
+        # Returns the table of candidate ids for each distinct (key, year) combination (padded with -1), the number of candidates of each combination
+        # and the combination of each building
+        pairs,inverse=np.unique(np.stack([keys,years],axis=1),axis=0,return_inverse=True)
+        resolved=[index.lookup(None if k==self.missing else k, None if y==self.missing else y) for k,y in pairs.tolist()]
+        counts=np.array([len(c) for c in resolved],dtype=np.int64)
+        table=np.full((len(resolved),max(counts.max(initial=0),1)),-1,dtype=np.int64)
+        for n,candidates in enumerate(resolved):
+            table[n,:len(candidates)]=[c[0] for c in candidates]
+        return table,counts,inverse.reshape(-1)
+
+    def assign_elements(self,index,keys,years,draws):
+        # Picks one candidate per building using one uniform draw in [0,1) per building. Returns -1 when there is no candidate.
+        table,counts,inverse=self.candidate_table(index,keys,years)
+        return draw_candidates(table,counts,inverse,draws)
+
+    def copy_mapping(self,cur,element,bbr_ids,choices,table=None):
+        # Writes the choices to the element's mapping table, or to another table with the same bbr_id and id columns
+        spec=linked_elements[element]
+        if table is None:
+            table=spec['mapping']
+        with cur.copy("COPY "+table+"(bbr_id, "+spec['column']+") FROM STDIN") as copy:
+            for bbr_id,choice in zip(bbr_ids,choices.tolist()):
+                copy.write_row((bbr_id, choice if choice>=0 else None)) # If there is no valid choice, add NULL to the mapping table
+
+    def link_element(self,element,dirty_only=False):
+        # If dirty_only is True, only the links of the dirty buildings are replaced
+        spec=linked_elements[element]
         conn=None
         try:
-            conn = pg.connect(self.db_params)
-            cur_elem=conn.cursor()
-            cur_elem.execute("SELECT * FROM roof_cover_types ORDER BY id")
-            elems = cur_elem.fetchall() # Retrieve the list of all roof cover types, which can be fed to the random choice function
-
-            cur = conn.cursor()
-            cur.execute("DELETE FROM buildings_to_roof_covers")    
-            cur.execute("SELECT id_lokalid, byg033tagdækningsmateriale, byg026opførelsesår, byg021bygningensanvendelse FROM buildings")
-            row = cur.fetchone() # Get properties from the first building as a tuple
-                
-            cur_write=conn.cursor()
-            row_number=0
+            conn = self.pool.getconn()
+            cur=conn.cursor()
 
-            while row is not None:
-                row_number+=1
-                clear_output(wait=True)
-                print(row_number)
-                bbr_material=row[1] # Get reported roof cover material for the building
-                cyear=row[2] # Get the building's construction year
-                roof_cover=self.get_roof_cover(elems, bbr_material, cyear)
-                if roof_cover is not None:
-                    # Add entry to the mapping table
-                    cur_write.execute("INSERT INTO buildings_to_roof_covers(bbr_id, roof_cover_id) VALUES (%s, %s)", (row[0], roof_cover[0]))
-                else:
-                    # If there is no valid choice, add None to the mapping table
-                    cur_write.execute("INSERT INTO buildings_to_roof_covers(bbr_id) VALUES (%s)", (row[0],))
-                
-                row=cur.fetchone() # Retrieve the next building as a tuple and iterate
+            index=candidate_index(self.load_types(cur,element),spec['criterion'])
+            where="id_lokalid IN (SELECT bbr_id FROM buildings_refresh)" if dirty_only else None
+            bbr_ids,years,keys=self.load_buildings(cur,element,where)
+            draws=self.get_draws(element,bbr_ids)
+            choices=self.assign_elements(index,keys,years,draws)
+
+            # The mapping table (or the rows of the dirty buildings) is replaced in a single transaction
+            if dirty_only:
+                cur.execute("DELETE FROM "+spec['mapping']+" WHERE bbr_id IN (SELECT bbr_id FROM buildings_refresh)")
+            else:
+                cur.execute("DELETE FROM "+spec['mapping'])
+            self.copy_mapping(cur,element,bbr_ids,choices)
+            generation=self.bump_generation(cur)
 
             conn.commit()
-            cur_write.close()
-            cur_elem.close()
+            self.cache_generation(generation)
             cur.close()
+            print('%s: %s buildings linked, %s without valid choice' % (element, len(bbr_ids), int((choices<0).sum())))
+            return True
 
         except (Exception, pg.DatabaseError) as error:
             print(error)
+            return False
         finally:
             if conn is not None:
-                conn.close()
+                self.pool.putconn(conn)
+
+    # Parallel linking
+    # The buildings table is split into shards (one per municipality, or by hash of the building id), which are linked by a pool of worker processes.
+    # Each worker has its own connection and writes its shard to unlogged staging tables. Once all shards are done, the mapping tables are replaced
+    # by the content of the staging tables in a single transaction, so that they are either all replaced or left untouched.
+    def staging_table(self,element,run):
+        # Staging tables are named after the run (see link_all_parallel), so that concurrent runs do not share them
+        return linked_elements[element]['mapping']+'_staging_'+run
+
+    def building_shards(self,shard_by='kommunekode',n_shards=None):
+        # Returns a list of (SQL condition, parameters) covering all buildings
+        if shard_by=='kommunekode':
+            conn=None
+            try:
+                conn = self.pool.getconn()
+                cur=conn.cursor()
+                cur.execute("SELECT DISTINCT kommunekode FROM buildings WHERE kommunekode IS NOT NULL ORDER BY kommunekode")
+                shards=[("kommunekode = %s",(r[0],)) for r in cur.fetchall()]
+                conn.commit()
+                cur.close()
+            finally:
+                if conn is not None:
+                    self.pool.putconn(conn)
+            shards.append(("kommunekode IS NULL",None))
+        elif shard_by=='hash':
+            shards=[("mod(abs(hashtext(id_lokalid)::bigint), %s) = %s",(n_shards,i)) for i in range(n_shards)]
+        else:
+            raise ValueError("shard_by must be 'kommunekode' or 'hash'")
+        return shards
 
-    def approx_roof_pitch(self):
+    def link_shard(self,elements,where,params,run):
+        # Links the buildings matching where for each element, and writes them to the staging tables in one transaction
         conn=None
         try:
-            conn = pg.connect(self.db_params)
+            conn = self.pool.getconn()
             cur=conn.cursor()
-            cur.execute("SELECT id_lokalid, byg033tagdækningsmateriale FROM buildings")
-            building = cur.fetchone() # Retrieve parameters for the first building.
-            
-            while building is not None:
-                bbr_material = building[1] # Retrieve the roof cover material
-                if bbr_material in [2,6]: # Depending on the type of roof cover material, the roof pitch is estimated
-                    pitch = 10
-                elif bbr_material in [3, 5, 10]:
-                    pitch = 40
-                elif bbr_material in [4, 90]:
-                    pitch = 35
-                elif bbr_material ==7:
-                    pitch = 20
-                else:             
-                    pitch = 1
-                    
-                cur2=conn.cursor()
-                # Insert the roof pitch value in the "buildings" table for the corresponding building.
-                cur2.execute("UPDATE buildings SET roof_pitch = %s WHERE id_lokalid = %s", (pitch, building[0]))
-                
-                building = cur.fetchone() # Retrieve the next building and iterate.
-
+            n_buildings=0
+            for element in elements:
+                index=candidate_index(self.load_types(cur,element),linked_elements[element]['criterion'])
+                bbr_ids,years,keys=self.load_buildings(cur,element,where,params)
+                draws=self.get_draws(element,bbr_ids)
+                choices=self.assign_elements(index,keys,years,draws)
+                self.copy_mapping(cur,element,bbr_ids,choices,self.staging_table(element,run))
+                n_buildings=len(bbr_ids)
             conn.commit()
-            cur2.close()
             cur.close()
-
-        except (Exception, pg.DatabaseError) as error:
-            print(error)
+            return n_buildings
         finally:
             if conn is not None:
-                conn.close()
+                self.pool.putconn(conn)
 
-    def get_roof_structure(self, elems, cyear, pitch): #This function selects all roof structure types that can be used with the building's roof pitch, then selects a random one based on construction year.
-        id_list = []
-        for elem in elems:
-            if elem[4] <= pitch and pitch <= elem[5]:
-                id_list.append(elem[0])
-        return self.random_possible_element(elems,id_list,cyear)  
+    def link_all_parallel(self,elements=None,workers=None,shard_by='kommunekode',n_shards=None):
+        if elements is None:
+            elements=list(linked_elements.keys())
+        if n_shards is None:
+            n_shards=4*(workers or 8)
+        run=os.urandom(6).hex()
 
-    def link_roof_structure(self):
+        conn=None
         try:
-            conn = pg.connect(self.db_params)
-            cur_elem=conn.cursor()
-            cur_elem.execute("SELECT * FROM roof_structure_types WHERE name NOT IN ('Ridge board', 'Top floor ceiling') ORDER BY id")
-            elems = cur_elem.fetchall() # Retrieve the list of all roof structure types, which can be fed to the random choice function
-
-            cur = conn.cursor()
-            cur.execute("DELETE FROM buildings_to_roof_structures")    
-            cur.execute("SELECT id_lokalid, byg026opførelsesår, byg021bygningensanvendelse, roof_pitch FROM buildings")
-            row = cur.fetchone() # Retrieve information for the first building
-                
-            cur_write=conn.cursor()
-            row_number=0
-
-            while row is not None:
-                row_number+=1
-                clear_output(wait=True)
-                print(row_number)
-                pitch=row[-1] # Retrieve the roof pitch
-                cyear=row[1] # Retrieve the construction year
-                roof_structure=self.get_roof_structure(elems, cyear, pitch) # Select a suitable roof structure based on roof pitch and construction year
-                if roof_structure is not None:
-                    # Add entry to the mapping table
-                    cur_write.execute("INSERT INTO buildings_to_roof_structures(bbr_id, roof_structure_id) VALUES (%s, %s)", (row[0], roof_structure[0]))
-                else:
-                    # If there is no suitable choice, add NULL to the mapping table.
-                    cur_write.execute("INSERT INTO buildings_to_roof_structures(bbr_id) VALUES (%s)", (row[0],))
+            conn = self.pool.getconn()
+            cur=conn.cursor()
 
-                row=cur.fetchone() # Retrieve the next building and iterate.
+            # Empty staging tables, visible to the workers
+            for element in elements:
+                spec=linked_elements[element]
+                cur.execute("CREATE UNLOGGED TABLE "+self.staging_table(element,run)+" (bbr_id varchar(50), "+spec['column']+" smallint)")
+            conn.commit()
 
+            shards=self.building_shards(shard_by,n_shards)
+            start=time.perf_counter()
+            n_buildings=0
+            with ProcessPoolExecutor(max_workers=workers,mp_context=worker_context,initializer=link_worker_init,initargs=(self.db_params,self.seed)) as executor:
+                jobs=[executor.submit(link_shard_worker,elements,where,params,run) for where,params in shards]
+                for n,job in enumerate(jobs):
+                    n_buildings+=job.result() # Raises the worker's error, if any
+                    clear_output(wait=True)
+                    print('%s/%s shards linked, %s buildings' % (n+1, len(shards), n_buildings))
+
+            # Replace all mapping tables at once. Concurrent runs replace them one after the other (the lock is released at commit).
+            cur.execute("SELECT pg_advisory_xact_lock(hashtext('link_all_parallel'))")
+            for element in elements:
+                spec=linked_elements[element]
+                cur.execute("DELETE FROM "+spec['mapping'])
+                cur.execute("INSERT INTO "+spec['mapping']+"(bbr_id, "+spec['column']+") SELECT bbr_id, "+spec['column']+" FROM "+self.staging_table(element,run))
+                cur.execute("DROP TABLE "+self.staging_table(element,run))
+            generation=self.bump_generation(cur)
             conn.commit()
-            cur_write.close()
-            cur_elem.close()
+            self.cache_generation(generation)
             cur.close()
+            print('%s buildings linked in %.1f s' % (n_buildings, time.perf_counter()-start))
 
         except (Exception, pg.DatabaseError) as error:
             print(error)
+            # Leave the mapping tables untouched. The failed connection is returned to the pool (which rolls it back) before removing the staging tables.
+            if conn is not None:
+                self.pool.putconn(conn)
+                conn=None
+            self.drop_staging_tables(elements,run)
         finally:
             if conn is not None:
-                conn.close()
+                self.pool.putconn(conn)
 
-    def add_ridge_board(self):
+    def drop_staging_tables(self,elements,run):
+        # Removes the staging tables of a failed run of link_all_parallel, on a fresh connection
+        conn=None
         try:
-            conn = pg.connect(self.db_params)
-            cur_elem=conn.cursor()
-            cur_elem.execute("SELECT id FROM roof_structure_types WHERE name = 'Ridge board'") # Select the ridge board macrocomponent
-            elem = cur_elem.fetchone()
-            
-            cur = conn.cursor()
-            cur.execute("""
-            SELECT b.id_lokalid
-            FROM buildings b 
-            INNER JOIN buildings_to_roof_structures btt ON b.id_lokalid=btt.bbr_id
-            INNER JOIN roof_structure_types typ ON typ.id=btt.roof_structure_id
-            WHERE typ.name NOT LIKE 'Flat%'
-            """) # Flat roofs do not have a ridge board, so we get all buildings that don't have a flat roof.
-            row = cur.fetchone() # Retrieve information for the first building
-            
-            cur_write=conn.cursor()
-            row_number=0
-                
-            while row is not None:
-                row_number+=1
-                clear_output(wait=True)
-                print(row_number)
-                cur_write.execute("INSERT INTO buildings_to_roof_structures(bbr_id, roof_structure_id) VALUES (%s, %s)", (row[0], elem[0]))
-
-                row=cur.fetchone() # Retrieve the next building and iterate.
-
+            conn = self.pool.getconn()
+            cur=conn.cursor()
+            for element in elements:
+                cur.execute("DROP TABLE IF EXISTS "+self.staging_table(element,run))
             conn.commit()
-            cur_elem.close()
-            cur_write.close()
             cur.close()
 
         except (Exception, pg.DatabaseError) as error:
-            print(error)
+            print('staging tables of run %s not removed: %s' % (run, error))
         finally:
             if conn is not None:
-                conn.close()
-
-    def add_top_floor_ceiling(self):
+                self.pool.putconn(conn)
+
+    # Functions for Monte Carlo ensembles (see ensemble_run)
+    def material_types(self,cur):
+        cur.execute(material_types_sql)
+        return [r[0] for r in cur.fetchall()]
+
+    def intensity_rows(self,cur,sql,materials,n_rows):
+        # Runs a query returning (row, material_type, kg per unit) and arranges the result as an array (rows x material types)
+        intensity=np.zeros((n_rows,len(materials)))
+        cur.execute(sql)
+        for row,material_type,kg in cur.fetchall():
+            if material_type in materials and kg is not None:
+                intensity[row,materials.index(material_type)]+=kg
+        return intensity
+
+    def load_intensities(self,cur,element,materials):
+        # kg of each material type per unit of quantity for each type of macrocomponent of the element (of quantified_elements, ridge boards being
+        # roof structure types), as an array (type id + 1 x material types). Row 0 stands for buildings without macrocomponent and stays empty.
+        spec=linked_elements['roof_structure' if element=='ridge_board' else element]
+        cur.execute("SELECT COALESCE(MAX(id),0) FROM "+spec['types'])
+        n_rows=cur.fetchone()[0]+2
+        return self.intensity_rows(cur,"SELECT type_id+1, material_type, SUM(kg) FROM macrocomponent_intensities WHERE element = '%s' GROUP BY type_id, material_type" % element,materials,n_rows)
+
+    def load_window_intensity(self,cur,materials):
+        # kg of each material type per unit of window surface, as an array
+        return self.intensity_rows(cur,"SELECT 0, material_type, SUM(kg) FROM macrocomponent_intensities WHERE element = 'window' GROUP BY material_type",materials,1)[0]
+
+    def load_ensemble_inputs(self,seed):
+        if not self.refresh_intensities():
+            raise RuntimeError('the intensities of the macrocomponents could not be rebuilt')
+        conn=None
         try:
-            conn = pg.connect(self.db_params)
-            cur_elem=conn.cursor()
-            cur_elem.execute("SELECT id FROM roof_structure_types WHERE name = 'Top floor ceiling'") # Select the top floor ceiling macrocomponent
-            elem = cur_elem.fetchone()
-            
-            cur = conn.cursor()
-            cur.execute("""
-            SELECT b.id_lokalid
-            FROM buildings b 
-            INNER JOIN buildings_to_roof_structures btt ON b.id_lokalid=btt.bbr_id
-            INNER JOIN roof_structure_types typ ON typ.id=btt.roof_structure_id
-            WHERE typ.name NOT IN ('Ridge board', 'Flat wood', 'Flat concrete')
-            """) # Flat roofs are assumed not to have additional beams on the top floor ceiling, so we get all buildings that don't have a flat roof.
-            row = cur.fetchone() # Retrieve information for the first building
-            
-            cur_write=conn.cursor()
-            row_number=0
-                
-            while row is not None:
-                row_number+=1
-                clear_output(wait=True)
-                print(row_number)
-                cur_write.execute("INSERT INTO buildings_to_roof_structures(bbr_id, roof_structure_id) VALUES (%s, %s)", (row[0], elem[0]))
-
-                row=cur.fetchone() # Retrieve the next building and iterate.
+            conn = self.pool.getconn()
+            cur=conn.cursor()
+            materials=self.material_types(cur)
+
+            columns=['b.id_lokalid','b.byg026opførelsesår']+['b.'+spec['bbr_column'] for spec in linked_elements.values() if spec['criterion'] is not None]+[e+'_quantity' for e in quantified_elements]
+            cur.execute("SELECT "+', '.join(columns)+" FROM buildings b, LATERAL (%s) ltp, LATERAL (%s) ltg" % (self.get_perimeter_sql,self.geometry_sql))
+            rows=cur.fetchall()
+            bbr_ids=[r[0] for r in rows]
+            years=np.array([self.missing if r[1] is None else r[1] for r in rows],dtype=np.int64)
+            quantities=np.array([r[-len(quantified_elements):] for r in rows],dtype=float).reshape(len(rows),len(quantified_elements))
+            quantities=np.nan_to_num(quantities) # NULL quantities give NULL amounts, which are ignored when summing weights
+
+            elements={}
+            n_key=2
+            for element,spec in linked_elements.items():
+                if spec['criterion'] is not None:
+                    keys=np.array([self.missing if r[n_key] is None else r[n_key] for r in rows],dtype=np.int64)
+                    n_key+=1
+                else:
+                    keys=np.zeros(len(rows),dtype=np.int64)
+                index=candidate_index(self.load_types(cur,element),spec['criterion'])
+                table,counts,inverse=self.candidate_table(index,keys,years)
+                elements[element]={'table':table,'counts':counts,'inverse':inverse,
+                                   'hashes':np.fromiter((building_hash(seed,element,b) for b in bbr_ids),dtype=np.uint64,count=len(bbr_ids)),
+                                   'intensity':self.load_intensities(cur,element,materials)}
+
+            # Ridge boards are added to all roof structures that are not flat
+            roof_structure=elements['roof_structure']
+            cur.execute("SELECT id, name NOT LIKE 'Flat%' FROM roof_structure_types")
+            roof_structure['has_ridge_board']=np.zeros(len(roof_structure['intensity']),dtype=bool)
+            for type_id,has_ridge_board in cur.fetchall():
+                roof_structure['has_ridge_board'][type_id+1]=has_ridge_board
+            ridge_board_intensity=self.load_intensities(cur,'ridge_board',materials)
+            cur.execute("SELECT id FROM roof_structure_types WHERE name = 'Ridge board'")
+            ridge_board=cur.fetchone()
+            ridge_board_intensity=ridge_board_intensity[ridge_board[0]+1] if ridge_board is not None else np.zeros(len(materials))
+
+            window_intensity=self.load_window_intensity(cur,materials)
 
             conn.commit()
-            cur_elem.close()
-            cur_write.close()
             cur.close()
+            return {'bbr_ids':bbr_ids,'materials':materials,'quantities':quantities,'elements':elements,
+                    'window_intensity':window_intensity,'ridge_board_intensity':ridge_board_intensity}
+        finally:
+            if conn is not None:
+                self.pool.putconn(conn)
+
+    def ensemble_material_amounts(self,iterations=100,workers=None,quantiles=(0.05,0.5,0.95),seed=None,sketch_size=32):
+        # Runs iterations assignments and quantifications of the whole stock, and returns a dictionary of DataFrames:
+        # 'mean' and 'std' (buildings x material types, in kg), one DataFrame of the same shape for each quantile q of quantiles ('q0.05', ...),
+        # estimated with quantile sketches of sketch_size items per level (see quantile_sketch, 0 to skip them and save memory),
+        # and 'totals' (statistics of the total weight of each material type in the stock)
+        if seed is None:
+            seed=self.seed if self.seed is not None else rd.getrandbits(64)
+        try:
+            start=time.perf_counter()
+            inputs=self.load_ensemble_inputs(seed)
+            inputs['sketch_size']=sketch_size
+
+            # Split the iterations between workers
+            if workers is None or workers<=1:
+                results=[ensemble_run(inputs,list(range(iterations)))]
+            else:
+                batches=[list(range(iterations))[w::workers] for w in range(workers) if w<iterations]
+                with ProcessPoolExecutor(max_workers=workers,mp_context=worker_context,initializer=ensemble_worker_init,initargs=(inputs,)) as executor:
+                    results=list(executor.map(ensemble_worker,batches))
+
+            # Merge the running statistics of all workers (Chan et al.)
+            count,mean,m2,totals,sketch=results[0]
+            for n,mean_n,m2_n,totals_n,sketch_n in results[1:]:
+                delta=mean_n-mean
+                mean=mean+delta*n/(count+n)
+                m2=m2+m2_n+delta**2*count*n/(count+n)
+                count+=n
+                totals.update(totals_n)
+                if sketch is not None:
+                    sketch.merge(sketch_n)
+
+            materials=inputs['materials']
+            index=pd.Index(inputs['bbr_ids'],name='bbr_id')
+            variance=m2/(count-1) if count>1 else np.zeros_like(m2)
+            totals=np.array([totals[i] for i in sorted(totals)])
+            stock=pd.DataFrame({'mean':totals.mean(axis=0),'std':totals.std(axis=0,ddof=1) if count>1 else 0.0},index=pd.Index(materials,name='material_type'))
+            for q in quantiles:
+                stock['q%s' % q]=np.quantile(totals,q,axis=0)
+
+            results={'mean':pd.DataFrame(mean,index=index,columns=materials),'std':pd.DataFrame(np.sqrt(variance),index=index,columns=materials),'totals':stock}
+            if sketch is not None:
+                for q,values in zip(quantiles,sketch.quantiles(quantiles)):
+                    results['q%s' % q]=pd.DataFrame(values,index=index,columns=materials)
+
+            print('%s iterations in %.1f s' % (count, time.perf_counter()-start))
+            return results
 
         except (Exception, pg.DatabaseError) as error:
             print(error)
+
+    def load_sweep_inputs(self,by=None):
+        # Buildings (with the column by), the macrocomponents linked to them and the kg of each material type per unit of quantity of each type
+        columns=['id_lokalid','byg021bygningensanvendelse','byg038samletbygningsareal','byg041bebyggetareal','byg054antaletager','roof_pitch']
+        if by is not None:
+            columns.append(by)
+        if not self.refresh_intensities():
+            raise RuntimeError('the intensities of the macrocomponents could not be rebuilt')
+        buildings=self.fetch_frame("SELECT "+', '.join(columns)+" FROM buildings")
+        links={element:self.fetch_frame("SELECT bbr_id, %s FROM %s WHERE %s IS NOT NULL" % (spec['column'],spec['mapping'],spec['column'])) for element,spec in linked_elements.items()}
+        conn=None
+        try:
+            conn = self.pool.getconn()
+            cur=conn.cursor()
+            materials=self.material_types(cur)
+            intensities={element:self.load_intensities(cur,element,materials) for element in quantified_elements if element!='window'}
+            window_intensity=self.load_window_intensity(cur,materials)
+            conn.commit()
+            cur.close()
         finally:
             if conn is not None:
-                conn.close()
-
-    def get_floor(self, elems, cyear): # This function just selects a random appropriate component given the building's construction year
-        id_list = []
-        for elem in elems:
-            id_list.append(elem[0])
-        return self.random_possible_element(elems,id_list,cyear)   
-
-    def get_int_wall(self,elems, cyear):
-        id_list = []
-        for elem in elems:
-            id_list.append(elem[0])
-        return self.random_possible_element(elems,id_list,cyear)  
-
-    def get_ground_slab(self,elems, cyear):
-        id_list = []
-        for elem in elems:
-            id_list.append(elem[0])
-        return self.random_possible_element(elems,id_list,cyear)   
-
-    def get_foundation(self,elems, cyear):
-        id_list = []
-        for elem in elems:
-            id_list.append(elem[0])
-        return self.random_possible_element(elems,id_list,cyear)  
-
-    def get_element(self,element,elems,cyear,**kwargs): # Calls the function to select one particular type of element
-        var=eval("self.get_"+element)(elems, cyear)
-        return var
-
-    def link_other_element(self,element):
+                self.pool.putconn(conn)
+        return {'buildings':buildings,'links':links,'materials':materials,'intensities':intensities,'window_intensity':window_intensity}
+
+    def parameter_sweep(self,default_floor_height=None,window_wall_ratio=None,space_efficiency=None,by=None):
+        # Weight of each material type in the stock for every combination of the given values of the parameters (lists of values, the value of
+        # this database if None), by value of the column by of the buildings (whole stock if None). Returns a dictionary with 'scenarios' (parameters
+        # of each scenario), 'materials', 'keys' and 'weights', an array of weights in kg (scenarios x material types x keys).
+        # The quantities are sums of terms, each a product of a factor depending on the building and a factor depending on the parameters
+        # (see sweep_terms). The weights of each term are aggregated once, and the weights of each scenario are sums of these aggregates.
+        parameters=[[self.default_floor_height] if default_floor_height is None else list(default_floor_height),
+                     [self.window_wall_ratio] if window_wall_ratio is None else list(window_wall_ratio),
+                     [self.space_efficiency] if space_efficiency is None else list(space_efficiency)]
+        combinations=list(itertools.product(*parameters))
         try:
-            conn = pg.connect(self.db_params)
-            cur_elem=conn.cursor()
-            cur_elem.execute("SELECT * FROM %s ORDER BY id" % (element+"_types",))
-            elems = cur_elem.fetchall() # Retrieve the list of all possible types for the given element, which can be fed to the random choice function
-            
-            cur = conn.cursor()
-            cur.execute("DELETE FROM buildings_to_"+element+"s")
-            cur.execute("SELECT id_lokalid, byg026opførelsesår, byg021bygningensanvendelse FROM buildings")
-            row = cur.fetchone() # Get properties from the first building as a tuple
-
-            cur_write=conn.cursor()
-            row_number=0
-
-            while row is not None:
-                row_number+=1
-                clear_output(wait=True)
-                print(row_number)
-                
-                cyear=row[1] # Get the building's construction year
-                elem=self.get_element(element,elems, cyear) # Select a suitable type for the given element in this building
-                if elem is not None:
-                    # Add entry to the mapping table
-                    cur_write.execute("INSERT INTO buildings_to_"+element+"s(bbr_id, "+element+"_id) VALUES (%s, %s)", (row[0],elem[0]))
+            start=time.perf_counter()
+            inputs=self.load_sweep_inputs(by)
+            buildings=inputs['buildings']
+            materials=inputs['materials']
+            if by is None:
+                codes,keys=np.zeros(len(buildings),dtype=np.int64),[None]
+            else:
+                codes,keys=pd.factorize(buildings[by],use_na_sentinel=False)
+                keys=list(keys)
+
+            # Factors depending on the buildings (the default engine gives the quantities that do not depend on the parameters)
+            engine=quantification_engine()
+            b=engine.arrays(buildings)
+            q=engine.quantities(buildings)
+            floors=b['byg054antaletager']
+            floor_area=b['floor_area']
+            perimeter=engine.perimeter(b)/engine.perimeter_float # Without the factor of the space efficiency
+            compact=(engine.use_formulas(b)==1)&~np.isnan(q['int_wall'])
+            with np.errstate(invalid='ignore'):
+                compactness=np.where(compact,0.0883*floor_area**(1-compactness_exponent),0)
+            int_wall=np.where(compact,engine.estimate_lb_internal_walls(b)+0.1803*floor_area,q['int_wall'])
+            wall=perimeter*np.where(np.isnan(floors),1,floors)
+            terms=np.zeros((len(sweep_terms),len(keys),len(materials)))
+
+            def aggregate(term,rows,factor,intensity):
+                weights=np.nan_to_num(factor[rows,None]*intensity) # NULL quantities give NULL amounts, which are ignored when summing weights
+                for m in range(len(materials)):
+                    terms[sweep_terms.index(term),:,m]+=np.bincount(codes[rows],weights=weights[:,m],minlength=len(keys))
+
+            bbr_ids=pd.Index(buildings['id_lokalid'])
+            for element,spec in linked_elements.items():
+                link=inputs['links'][element]
+                rows=bbr_ids.get_indexer(link['bbr_id'])
+                types=link[spec['column']].to_numpy(dtype=np.int64)
+                types,rows=types[rows>=0],rows[rows>=0]
+                intensity=inputs['intensities'][element][types+1] # Types not quantified as this element have no intensity
+                if element=='ext_wall':
+                    aggregate('wall',rows,wall,intensity)
+                elif element=='int_wall':
+                    aggregate('fixed',rows,int_wall,intensity)
+                    aggregate('compactness_area',rows,compactness*b['byg041bebyggetareal'],intensity)
+                    aggregate('compactness_wall',rows,compactness*perimeter*np.where(floors>0,floors,1),intensity)
+                elif element=='roof_structure':
+                    aggregate('fixed',rows,q['roof_structure'],intensity)
+                    aggregate('ridge_board',rows,np.sqrt(b['byg041bebyggetareal']),inputs['intensities']['ridge_board'][types+1])
                 else:
-                    # If there is no suitable choice, add None to the mapping table
-                    cur_write.execute("INSERT INTO buildings_to_"+element+"s(bbr_id) VALUES (%s)", (row[0],))
+                    aggregate('fixed',rows,q[element],intensity)
+            aggregate('window',np.arange(len(buildings)),wall,np.broadcast_to(inputs['window_intensity'],(len(buildings),len(materials))))
 
-                row=cur.fetchone() # Retrieve the next building as a tuple and iterate
+            factors=np.array([sweep_factors(quantification_engine(*p)) for p in combinations]) # Integer values keep the integer arithmetic of the SQL path
+            weights=np.einsum('st,tkm->smk',factors,terms)
+            print('%s scenarios in %.1f s' % (len(combinations), time.perf_counter()-start))
+            scenarios=pd.DataFrame(combinations,columns=['default_floor_height','window_wall_ratio','space_efficiency'])
+            return {'scenarios':scenarios,'materials':materials,'keys':keys,'weights':weights}
 
-            conn.commit()
-            cur_write.close()
-            cur_elem.close()
-            cur.close()
+        except (Exception, pg.DatabaseError) as error:
+            print(error)
+
+    def stock_matrices(self):
+        # Sparse matrices of the stock with the current quantities (see stock_matrices). scipy is only needed for this function.
+        try:
+            import scipy.sparse as sparse
+        except ImportError:
+            print('scipy is required to build sparse matrices')
+            return
+        try:
+            start=time.perf_counter()
+            if not self.refresh_intensities():
+                return
+            conn=None
+            try:
+                conn = self.pool.getconn()
+                cur=conn.cursor()
+                materials=self.material_types(cur)
+                conn.commit()
+                cur.close()
+            finally:
+                if conn is not None:
+                    self.pool.putconn(conn)
+
+            geometry=self.fetch_frame("SELECT b.id_lokalid, ltg.* FROM buildings b, LATERAL (%s) ltp, LATERAL (%s) ltg" % (self.get_perimeter_sql,self.geometry_sql))
+            links={element:self.fetch_frame("SELECT bbr_id, %s FROM %s WHERE %s IS NOT NULL" % (spec['column'],spec['mapping'],spec['column'])) for element,spec in linked_elements.items()}
+            intensities=self.fetch_frame("SELECT element, COALESCE(type_id,-1) type_id, product, unit, amount FROM macrocomponent_intensities")
+            factors=self.fetch_frame("""SELECT DISTINCT mi.product, mi.unit, pr.material_type, (CASE WHEN mi.unit='KG' THEN 1 WHEN mi.unit='M3' THEN pr.density ELSE NULL END) factor
+            FROM macrocomponent_intensities mi INNER JOIN products pr ON pr.name = mi.product""")
+
+            macrocomponents=intensities[['element','type_id']].drop_duplicates().sort_values(['element','type_id'],ignore_index=True)
+            macrocomponents=pd.concat([macrocomponents[macrocomponents['element']!='window'],pd.DataFrame({'element':['window'],'type_id':[-1]})],ignore_index=True)
+            products=intensities[['product','unit']].drop_duplicates().sort_values(['product','unit'],ignore_index=True)
+            product_index=pd.MultiIndex.from_frame(products)
+
+            rows=pd.MultiIndex.from_frame(macrocomponents).get_indexer(pd.MultiIndex.from_frame(intensities[['element','type_id']]))
+            cols=product_index.get_indexer(pd.MultiIndex.from_frame(intensities[['product','unit']]))
+            amounts=sparse.csr_matrix((np.nan_to_num(intensities['amount'].to_numpy(dtype=np.float64)),(rows,cols)),shape=(len(macrocomponents),len(products)))
+
+            factors=factors[factors['material_type'].isin(materials)&factors['factor'].notna()]
+            rows=product_index.get_indexer(pd.MultiIndex.from_frame(factors[['product','unit']]))
+            cols=np.array([materials.index(m) for m in factors['material_type']],dtype=np.int64)
+            densities=sparse.csr_matrix((factors['factor'].to_numpy(dtype=np.float64),(rows,cols)),shape=(len(products),len(materials)))
+
+            quantities={element:geometry[element+'_quantity'].to_numpy() for element in quantified_elements}
+            matrices=stock_matrices(geometry['id_lokalid'],macrocomponents,products,materials,
+                                    geometry_matrix(geometry['id_lokalid'],quantities,links,macrocomponents),amounts,densities)
+            print('stock matrices built in %.1f s' % (time.perf_counter()-start))
+            return matrices
 
         except (Exception, pg.DatabaseError) as error:
             print(error)
-        finally:
-            if conn is not None:
-                conn.close()
 
     def link_ground_slab(self):
         self.link_other_element('ground_slab')
@@ -1023,21 +2260,21 @@ class macrocomponent_database:
         connector = None
         bbrid = None
         try:
-            # connect to the PostgreSQL database
-            connector = pg.connect(self.db_params)
+            # borrow a connection from the pool
+            connector = self.pool.getconn()
             # create a new cursor
             cur = connector.cursor()
             # execute the INSERT statement
             cur.executemany(sql, list_of_rows)
             # commit the changes to the database
             connector.commit()
-            # close communication with the database
+            # close the cursor, the connection is returned to the pool below
             cur.close()
         except (Exception, pg.DatabaseError) as error:
             print(error)
         finally:
             if connector is not None:
-                connector.close()
+                self.pool.putconn(connector)
 
     def add_lcabyg_subcomponents(self, read_lcabyg_constructions):
         list_of_const=[]
@@ -1057,21 +2294,21 @@ class macrocomponent_database:
         connector = None
         bbrid = None
         try:
-            # connect to the PostgreSQL database
-            connector = pg.connect(self.db_params)
+            # borrow a connection from the pool
+            connector = self.pool.getconn()
             # create a new cursor
             cur = connector.cursor()
             # execute the INSERT statement
             cur.executemany(sql, list_of_prods)
             # commit the changes to the database
             connector.commit()
-            # close communication with the database
+            # close the cursor, the connection is returned to the pool below
             cur.close()
         except (Exception, pg.DatabaseError) as error:
             print(error)
         finally:
             if connector is not None:
-                connector.close()
+                self.pool.putconn(connector)
 
     def add_lcabyg_products(self, read_lcabyg_products):
         list_of_prods=[]
@@ -1087,8 +2324,6 @@ class macrocomponent_database:
         self.insert_product(list_of_prods)
 
     def map_components_to_products(self,read_lcabyg_constructions):
-            self.run_sql("DELETE FROM subcomponents_to_products")
-
             list_of_edges=[]
             for c in read_lcabyg_constructions:
                 for key in c.keys():        
@@ -1105,7 +2340,7 @@ class macrocomponent_database:
             connector=None
 
             try:
-                connector = pg.connect(self.db_params)
+                connector = self.pool.getconn()
                 
                 # fetch construction ids
                 cur_const = connector.cursor()
@@ -1146,8 +2381,12 @@ class macrocomponent_database:
                 sql_prod = "INSERT INTO products(lcabyg_id, name) VALUES(%s, 'missing product') ON CONFLICT ON CONSTRAINT products_pkey DO NOTHING"
                 cur.executemany(sql_prod, missing_products)
                 
-                # insert edges in mapping table
+                # replace the edges in mapping table
+                cur.execute("DELETE FROM subcomponents_to_products")
                 cur.executemany(sql, list_of_edges)
+
+                # the intensities of the macrocomponents depend on the edges, they are rebuilt in the same transaction
+                self.build_intensities(cur)
                 
                 # commit the changes to the database
                 connector.commit()
@@ -1159,16 +2398,16 @@ class macrocomponent_database:
                 print(error)
             finally:
                 if connector is not None:
-                    connector.close()
+                    self.pool.putconn(connector)
 
     # Functions to calculate material amounts
-    def estimate_lb_internal_walls(self):
+    def estimate_lb_internal_walls(self,dirty_only=False):
         fill_int_walls_lb="""
         WITH iws AS (
         SELECT
         b.id_lokalId AS bbrid,
         intwallsurface
-        FROM buildings b,
+        FROM %s b,
         LATERAL (SELECT b.byg021BygningensAnvendelse::int4 AS use_code) lt1,
         LATERAL (SELECT COALESCE(b.byg038SamletBygningsareal,b.byg041BebyggetAreal) AS floor_area) lt2,
         LATERAL (SELECT 
@@ -1189,17 +2428,17 @@ class macrocomponent_database:
 
         INSERT INTO buildings (id_lokalId,int_wall_surface_lb)
         SELECT bbrid, intwallsurface FROM iws
-        ON CONFLICT ON CONSTRAINT buildings_pkey DO UPDATE SET (id_lokalId,int_wall_surface_lb) = (EXCLUDED.id_lokalId,EXCLUDED.int_wall_surface_lb)"""
+        ON CONFLICT ON CONSTRAINT buildings_pkey DO UPDATE SET (id_lokalId,int_wall_surface_lb) = (EXCLUDED.id_lokalId,EXCLUDED.int_wall_surface_lb)""" % self.buildings_source(dirty_only)
 
-        self.run_sql(fill_int_walls_lb)
+        return self.run_sql(fill_int_walls_lb)
 
-    def estimate_nlb_internal_walls(self):
+    def estimate_nlb_internal_walls(self,dirty_only=False):
         fill_int_walls_nlb="""
         WITH iws AS (
         SELECT
         b.id_lokalId AS bbrid,
         intwallsurface
-        FROM buildings b,
+        FROM %s b,
         LATERAL (SELECT b.byg021BygningensAnvendelse::int4 AS use_code) lt1,
         LATERAL (SELECT COALESCE(b.byg038SamletBygningsareal,b.byg041BebyggetAreal) AS floor_area) lt2,
         LATERAL (SELECT %s*floor_area AS volume) lt3,
@@ -1225,11 +2464,14 @@ class macrocomponent_database:
         INSERT INTO buildings (id_lokalId,int_wall_surface_nlb)
         SELECT bbrid, intwallsurface FROM iws
         ON CONFLICT ON CONSTRAINT buildings_pkey DO UPDATE SET (id_lokalId,int_wall_surface_nlb) = (EXCLUDED.id_lokalId,EXCLUDED.int_wall_surface_nlb)
-        """ % (self.default_floor_height,self.get_perimeter_sql,self.default_floor_height,self.default_floor_height)
+        """ % (self.buildings_source(dirty_only), self.default_floor_height,self.get_perimeter_sql,self.default_floor_height,self.default_floor_height)
 
-        self.run_sql(fill_int_walls_nlb)
+        return self.run_sql(fill_int_walls_nlb)
 
-    def amounts_ext_walls(self):
+    # The amounts_* functions insert the amounts of one building part (of all buildings, or of the buildings of buildings_refresh if dirty_only is True)
+    # into results_material_amounts. calculate_material_amounts does the same for all building parts in one statement, and no longer calls them.
+    # They are kept for step by step calculations, and return the status of run_sql like the other steps.
+    def amounts_ext_walls(self,dirty_only=False):
         result_ext_wall_sql="""
         WITH quant_table AS
         (SELECT 
@@ -1237,7 +2479,7 @@ class macrocomponent_database:
             pr.name product,
             amount_product,
             pmap.unit unit
-        FROM buildings b
+        FROM %s b
         INNER JOIN buildings_to_ext_walls bmap
             ON b.id_lokalId = bmap.bbr_id
         INNER JOIN ext_wall_types typ
@@ -1256,11 +2498,11 @@ class macrocomponent_database:
         INSERT INTO results_material_amounts(element, product, amount, unit, bbr_id)
         SELECT 'ext_wall', product, amount_product, unit, bbrid
         FROM quant_table
-        """ % (self.get_perimeter_sql, self.default_floor_height, self.window_wall_ratio, self.default_floor_height, self.window_wall_ratio)
+        """ % (self.buildings_source(dirty_only), self.get_perimeter_sql, self.default_floor_height, self.window_wall_ratio, self.default_floor_height, self.window_wall_ratio)
 
-        self.run_sql(result_ext_wall_sql)
+        return self.run_sql(result_ext_wall_sql)
 
-    def amounts_windows(self):
+    def amounts_windows(self,dirty_only=False):
         result_window_sql="""
         WITH quant_table AS
         (SELECT 
@@ -1268,7 +2510,7 @@ class macrocomponent_database:
             pr.name product,
             amount_product,
             pmap.unit unit
-        FROM buildings b
+        FROM %s b
         INNER JOIN subcomponents sc ON sc.name = 'Window - iBuildGreen'
         INNER JOIN subcomponents_to_products pmap
             ON pmap.subcomponent_id = sc.lcabyg_id
@@ -1280,18 +2522,18 @@ class macrocomponent_database:
         INSERT INTO results_material_amounts(element, product, amount, unit, bbr_id)
         SELECT 'window', product, amount_product, unit, bbrid
         FROM quant_table
-        """ % (self.get_perimeter_sql, self.default_floor_height, self.window_wall_ratio, self.default_floor_height, self.window_wall_ratio)
+        """ % (self.buildings_source(dirty_only), self.get_perimeter_sql, self.default_floor_height, self.window_wall_ratio, self.default_floor_height, self.window_wall_ratio)
 
-        self.run_sql(result_window_sql)
+        return self.run_sql(result_window_sql)
 
-    def amounts_int_walls(self):
+    def amounts_int_walls(self,dirty_only=False):
         result_int_wall_sql="""WITH quant_table AS
         (SELECT 
             b.id_lokalId bbrid,
             pr.name product,
             amount_product,
             pmap.unit unit
-        FROM buildings b
+        FROM %s b
         INNER JOIN buildings_to_int_walls bmap
             ON b.id_lokalId = bmap.bbr_id
         INNER JOIN int_wall_types typ
@@ -1309,17 +2551,17 @@ class macrocomponent_database:
         INSERT INTO results_material_amounts(element,product,amount,unit, bbr_id)
         SELECT 'int_wall',product,amount_product, unit, bbrid
         FROM quant_table
-        """
-        self.run_sql(result_int_wall_sql)
+        """ % self.buildings_source(dirty_only)
+        return self.run_sql(result_int_wall_sql)
 
-    def amounts_roof_covers(self):
+    def amounts_roof_covers(self,dirty_only=False):
         result_roof_cover_sql="""WITH quant_table AS
         (SELECT 
             b.id_lokalId bbrid,
             pr.name product,
             amount_product,
             pmap.unit unit
-        FROM buildings b
+        FROM %s b
         INNER JOIN buildings_to_roof_covers bmap
             ON b.id_lokalId = bmap.bbr_id
         INNER JOIN roof_cover_types typ
@@ -1338,17 +2580,17 @@ class macrocomponent_database:
         INSERT INTO results_material_amounts(element,product,amount,unit, bbr_id)
         SELECT 'roof_cover',product,amount_product, unit, bbrid
         FROM quant_table
-        """
-        self.run_sql(result_roof_cover_sql)
+        """ % self.buildings_source(dirty_only)
+        return self.run_sql(result_roof_cover_sql)
 
-    def amounts_roof_structures(self):
+    def amounts_roof_structures(self,dirty_only=False):
         result_roof_structure_sql="""WITH quant_table AS
         (SELECT 
             b.id_lokalId bbrid,
             pr.name product,
             amount_product,
             pmap.unit unit
-        FROM buildings b
+        FROM %s b
         INNER JOIN buildings_to_roof_structures bmap
             ON b.id_lokalId = bmap.bbr_id
         INNER JOIN roof_structure_types typ
@@ -1368,17 +2610,17 @@ class macrocomponent_database:
         INSERT INTO results_material_amounts(element,product,amount,unit, bbr_id)
         SELECT 'roof_structure',product,amount_product, unit, bbrid
         FROM quant_table
-        """
-        self.run_sql(result_roof_structure_sql)
+        """ % self.buildings_source(dirty_only)
+        return self.run_sql(result_roof_structure_sql)
 
-    def amounts_floors(self):
+    def amounts_floors(self,dirty_only=False):
         result_floor_sql="""WITH quant_table AS
         (SELECT 
             b.id_lokalId bbrid,
             pr.name product,
             amount_product,
             pmap.unit unit
-        FROM buildings b
+        FROM %s b
         INNER JOIN buildings_to_floors bmap
             ON b.id_lokalId = bmap.bbr_id
         INNER JOIN floor_types typ
@@ -1396,17 +2638,17 @@ class macrocomponent_database:
         INSERT INTO results_material_amounts(element,product,amount,unit, bbr_id)
         SELECT 'floor',product,amount_product, unit, bbrid
         FROM quant_table
-        """
-        self.run_sql(result_floor_sql)
+        """ % self.buildings_source(dirty_only)
+        return self.run_sql(result_floor_sql)
 
-    def amounts_foundations(self):
+    def amounts_foundations(self,dirty_only=False):
         result_foundation_sql="""WITH quant_table AS
         (SELECT 
             b.id_lokalId bbrid,
             pr.name product,
             amount_product,
             pmap.unit unit
-        FROM buildings b
+        FROM %s b
         INNER JOIN buildings_to_foundations bmap
             ON b.id_lokalId = bmap.bbr_id
         INNER JOIN foundation_types typ
@@ -1424,17 +2666,17 @@ class macrocomponent_database:
         INSERT INTO results_material_amounts(element,product,amount,unit, bbr_id)
         SELECT 'foundation',product,amount_product, unit, bbrid
         FROM quant_table
-        """
-        self.run_sql(result_foundation_sql)
+        """ % self.buildings_source(dirty_only)
+        return self.run_sql(result_foundation_sql)
 
-    def amounts_ridge_boards(self):
+    def amounts_ridge_boards(self,dirty_only=False):
         result_ridge_board_sql="""WITH quant_table AS
         (SELECT 
             b.id_lokalId bbrid,
             pr.name product,
             amount_product,
             pmap.unit unit
-        FROM buildings b
+        FROM %s b
         INNER JOIN buildings_to_roof_structures bmap
             ON b.id_lokalId = bmap.bbr_id
         INNER JOIN roof_structure_types typ
@@ -1454,17 +2696,17 @@ class macrocomponent_database:
         INSERT INTO results_material_amounts(element,product,amount,unit, bbr_id)
         SELECT 'ridge_board',product,amount_product, unit, bbrid
         FROM quant_table
-        """ % self.space_efficiency
-        self.run_sql(result_ridge_board_sql)
+        """ % (self.buildings_source(dirty_only), self.space_efficiency)
+        return self.run_sql(result_ridge_board_sql)
 
-    def amounts_ground_slabs(self):
+    def amounts_ground_slabs(self,dirty_only=False):
         result_ground_slab_sql="""WITH quant_table AS
         (SELECT 
             b.id_lokalId bbrid,
             pr.name product,
             amount_product,
             pmap.unit unit
-        FROM buildings b
+        FROM %s b
         INNER JOIN buildings_to_ground_slabs bmap
             ON b.id_lokalId = bmap.bbr_id
         INNER JOIN ground_slab_types typ
@@ -1482,34 +2724,436 @@ class macrocomponent_database:
         INSERT INTO results_material_amounts(element,product,amount,unit, bbr_id)
         SELECT 'ground_slab',product,amount_product, unit, bbrid
         FROM quant_table
-        """
-        self.run_sql(result_ground_slab_sql)
-
-    def calculate_material_amounts(self):
-        self.run_sql("DELETE FROM results_material_amounts")
-        self.amounts_ext_walls()
-        self.amounts_windows()
-        self.amounts_int_walls()
-        self.amounts_floors()
-        self.amounts_foundations()
-        self.amounts_ground_slabs()
-        self.amounts_ridge_boards()
-        self.amounts_roof_covers()
-        self.amounts_roof_structures()
-
-
-
-
-
-
-
-
-
+        """ % self.buildings_source(dirty_only)
+        return self.run_sql(result_ground_slab_sql)
+
+    def calculate_material_amounts(self,dirty_only=False):
+        # Fused version of the amounts_* functions: the geometry of each building (see geometry_sql) is computed once into a temporary table,
+        # from which the amounts of all building parts are inserted by a single statement, in a single transaction.
+        # A full calculation empties results_material_amounts with TRUNCATE and rebuilds its indexes after loading, which is much faster than updating them row by row.
+        # If dirty_only is True, only the material amounts of the dirty buildings are replaced.
+        start=time.perf_counter()
+        if not self.refresh_intensities():
+            return False
+        conn=None
+        try:
+            conn = self.pool.getconn()
+            cur=conn.cursor()
+            cur.execute("CREATE TEMP TABLE building_geometry ON COMMIT DROP AS SELECT b.id_lokalId bbr_id, ltg.* FROM %s b, LATERAL (%s) ltp, LATERAL (%s) ltg"
+                        % (self.buildings_source(dirty_only),self.get_perimeter_sql,self.geometry_sql))
+            cur.execute("ANALYZE building_geometry")
 
+            if dirty_only:
+                cur.execute("DELETE FROM results_material_amounts WHERE bbr_id IN (SELECT bbr_id FROM buildings_refresh)")
+                cur.execute(self.quantification_sql())
+            else:
+                # Secondary indexes are dropped during the load and created again afterwards (constraints such as the primary key are kept)
+                cur.execute("""SELECT i.indexrelid::regclass::text, pg_get_indexdef(i.indexrelid) FROM pg_index i
+                WHERE i.indrelid = 'results_material_amounts'::regclass AND NOT EXISTS (SELECT 1 FROM pg_constraint c WHERE c.conindid = i.indexrelid)""")
+                indexes=cur.fetchall()
+                for name,definition in indexes:
+                    cur.execute("DROP INDEX "+name)
+                cur.execute("TRUNCATE results_material_amounts")
+                cur.execute(self.quantification_sql())
+                for name,definition in indexes:
+                    cur.execute(definition)
+            cur.execute("CREATE INDEX IF NOT EXISTS results_material_amounts_bbr_id ON results_material_amounts (bbr_id)")
+            conn.commit()
+            cur.execute("ANALYZE results_material_amounts")
+            conn.commit()
+            cur.close()
+            print('material amounts calculated in %.1f s' % (time.perf_counter()-start))
 
+        except (Exception, pg.DatabaseError) as error:
+            print(error)
+            return False
+        finally:
+            if conn is not None:
+                self.pool.putconn(conn)
+
+        return self.refresh_weights(dirty_only) and self.refresh_material_cube(dirty_only)
+
+    def quantification_sql(self):
+        # Single INSERT of the material amounts of all building parts, from the quantities in building_geometry and the amounts of products
+        # per unit of each macrocomponent type in macrocomponent_intensities (same results as the amounts_* functions)
+        selects=[]
+        for element in quantified_elements:
+            if element=='window':
+                selects.append("""
+        SELECT 'window', mi.product, g.window_quantity*mi.amount, mi.unit, g.bbr_id
+        FROM building_geometry g
+        INNER JOIN macrocomponent_intensities mi ON mi.element = 'window'""")
+                continue
+
+            # Ridge boards are roof structures, linked to the buildings by add_ridge_board
+            spec=linked_elements['roof_structure' if element=='ridge_board' else element]
+            selects.append("""
+        SELECT '%s', mi.product, g.%s_quantity*mi.amount, mi.unit, g.bbr_id
+        FROM building_geometry g
+        INNER JOIN %s bmap ON g.bbr_id = bmap.bbr_id
+        INNER JOIN macrocomponent_intensities mi ON mi.element = '%s' AND mi.type_id = bmap.%s""" % (element,element,spec['mapping'],element,spec['column']))
+
+        return "INSERT INTO results_material_amounts(element, product, amount, unit, bbr_id)"+"\n        UNION ALL".join(selects)
+
+    def intensities_sql(self):
+        # Products of each macrocomponent type of each element of quantified_elements (the five-table join of the amounts_* functions), with their
+        # amount per unit of quantity and their weight in kg per unit of quantity
+        kg="(CASE WHEN pmap.unit='KG' THEN pmap.amount WHEN pmap.unit='M3' THEN pmap.amount*pr.density ELSE NULL END)"
+        selects=[]
+        for element in quantified_elements:
+            if element=='window':
+                selects.append("""
+        SELECT 'window', NULL::integer, pr.name, pmap.unit, pmap.amount, pr.material_type, %s
+        FROM subcomponents sc
+        INNER JOIN subcomponents_to_products pmap ON pmap.subcomponent_id = sc.lcabyg_id
+        INNER JOIN products pr ON pr.lcabyg_id = pmap.product_id
+        WHERE sc.name = 'Window - iBuildGreen'""" % kg)
+                continue
+
+            spec=linked_elements['roof_structure' if element=='ridge_board' else element]
+            sql="""
+        SELECT '%s', typ.id, pr.name, pmap.unit, pmap.amount, pr.material_type, %s
+        FROM %s typ
+        INNER JOIN %s submap ON typ.id = submap.%s
+        INNER JOIN subcomponents sc ON sc.lcabyg_id = submap.subcomponent_id
+        INNER JOIN subcomponents_to_products pmap ON pmap.subcomponent_id = sc.lcabyg_id
+        INNER JOIN products pr ON pr.lcabyg_id = pmap.product_id""" % (element,kg,spec['types'],spec['subcomponents'],spec['column'])
+            if element=='ridge_board':
+                sql+="""
+        WHERE typ.name = 'Ridge board'"""
+            elif 'types_filter' in spec:
+                sql+="""
+        WHERE typ."""+spec['types_filter']
+            selects.append(sql)
+
+        return "INSERT INTO macrocomponent_intensities(element, type_id, product, unit, amount, material_type, kg)"+"\n        UNION ALL".join(selects)
+
+    def build_intensities(self,cur):
+        # The macrocomponent_intensities table only depends on the catalogue, so it is built once per calculation instead of joining the catalogue
+        # again for every building. It is small, and rebuilt at the start of every function reading it, so that changes of the catalogue (edges,
+        # densities or material types of the products) are never missed. Rows are replaced with DELETE rather than TRUNCATE, so that readers are
+        # not blocked, and the lock serialises concurrent rebuilds.
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS macrocomponent_intensities (
+            element character varying,
+            type_id integer,
+            product text,
+            unit character varying,
+            amount real,
+            material_type character varying,
+            kg real)""")
+        cur.execute("CREATE INDEX IF NOT EXISTS macrocomponent_intensities_type ON macrocomponent_intensities (element, type_id)")
+        cur.execute("SELECT pg_advisory_xact_lock(hashtext('macrocomponent_intensities'))")
+        cur.execute("DELETE FROM macrocomponent_intensities")
+        cur.execute(self.intensities_sql())
+        cur.execute("ANALYZE macrocomponent_intensities")
+
+    def refresh_intensities(self):
+        # Rebuilds macrocomponent_intensities in its own transaction (see build_intensities)
+        conn=None
+        try:
+            conn = self.pool.getconn()
+            cur=conn.cursor()
+            self.build_intensities(cur)
+            conn.commit()
+            cur.close()
+            return True
 
+        except (Exception, pg.DatabaseError) as error:
+            print(error)
+            return False
+        finally:
+            if conn is not None:
+                self.pool.putconn(conn)
+
+    def engine(self):
+        # In-memory quantification engine with the parameters of this database (see quantification_engine)
+        return quantification_engine(self.default_floor_height,self.window_wall_ratio,self.space_efficiency)
+
+    def engine_inputs(self,estimate_walls=False):
+        # Buildings, mapping tables and catalogue as inputs of quantification_engine.material_amounts. If estimate_walls is True, the internal wall
+        # surfaces are left out of the buildings, so that the engine estimates them with its own parameters.
+        columns=['id_lokalid','byg021bygningensanvendelse','byg038samletbygningsareal','byg041bebyggetareal','byg054antaletager','roof_pitch']
+        if not estimate_walls:
+            columns+=['int_wall_surface_lb','int_wall_surface_nlb']
+        buildings=self.fetch_frame("SELECT "+', '.join(columns)+" FROM buildings")
+        links={element:self.fetch_frame("SELECT bbr_id, %s FROM %s" % (spec['column'],spec['mapping'])) for element,spec in linked_elements.items()}
+        catalogue={'types':{element:self.fetch_frame("SELECT id, name FROM "+spec['types']) for element,spec in linked_elements.items()},
+                   'subcomponents':{element:self.fetch_frame("SELECT %s, subcomponent_id FROM %s" % (spec['column'],spec['subcomponents'])) for element,spec in linked_elements.items()},
+                   'subcomponent_names':self.fetch_frame("SELECT lcabyg_id, name FROM subcomponents"),
+                   'subcomponents_to_products':self.fetch_frame("SELECT subcomponent_id, product_id, amount, unit FROM subcomponents_to_products"),
+                   'products':self.fetch_frame("SELECT lcabyg_id, name FROM products")}
+        return buildings,links,catalogue
+
+    def refresh_weights(self,dirty_only=False):
+        # The results_weights table holds the weight in kg of each product of each building part, with its material type, so that the results
+        # and material amounts can be queried without joining the products table and converting units. It is refreshed by calculate_material_amounts.
+        # After modifying results_material_amounts or products directly (e.g. in notebook 6), run refresh_derived_results instead.
+        conn=None
+        try:
+            conn = self.pool.getconn()
+            cur=conn.cursor()
+            cur.execute(results_weights_table_sql)
+            cur.execute(results_weights_index_sql)
+            if dirty_only:
+                cur.execute("DELETE FROM results_weights WHERE bbr_id IN (SELECT bbr_id FROM buildings_refresh)")
+                cur.execute(results_weights_insert_sql+"WHERE rma.bbr_id IN (SELECT bbr_id FROM buildings_refresh)")
+            else:
+                cur.execute("TRUNCATE results_weights")
+                cur.execute(results_weights_insert_sql)
+            generation=self.bump_generation(cur)
+            conn.commit()
+            self.cache_generation(generation)
+            cur.execute("ANALYZE results_weights")
+            conn.commit()
+            cur.close()
+            return True
 
+        except (Exception, pg.DatabaseError) as error:
+            print(error)
+            return False
+        finally:
+            if conn is not None:
+                self.pool.putconn(conn)
 
+    def ensure_weights(self):
+        # Builds results_weights if it does not exist yet (databases filled before it was introduced). Checked once per object, before the first query reading it.
+        if self.weights_checked:
+            return
+        conn=None
+        try:
+            conn = self.pool.getconn()
+            cur=conn.cursor()
+            cur.execute(ensure_weights_sql[0])
+            cur.execute(ensure_weights_sql[1])
+            if cur.fetchone()[0]:
+                cur.execute(results_weights_table_sql)
+                cur.execute(results_weights_index_sql)
+                cur.execute(results_weights_insert_sql)
+            conn.commit()
+            cur.close()
+            self.weights_checked=True
+        finally:
+            if conn is not None:
+                self.pool.putconn(conn)
+
+    def refresh_derived_results(self):
+        # Rebuilds everything derived from results_material_amounts: results_weights, the generation of the cached results and material_cube.
+        # To be run after modifying results_material_amounts or the products table directly (e.g. in notebook 6), otherwise queries return the old amounts.
+        return self.refresh_weights() and self.refresh_material_cube()
+
+    def refresh_material_cube(self,dirty_only=False):
+        # The material_cube table holds the total weight (in kg) of each material type of each building part, by municipality, BBR use code
+        # and construction decade. It is refreshed from results_weights by calculate_material_amounts. Since it only holds sums,
+        # any coarser aggregate is the sum of its rows (see material_cube).
+        # material_cube_buildings records the cell in which each building is counted. When refreshing the buildings of buildings_refresh only,
+        # just the cells they were counted in and the cells they now belong to are recomputed, from the buildings recorded in these cells.
+        conn=None
+        try:
+            conn = self.pool.getconn()
+            cur=conn.cursor()
+            cur.execute("SELECT to_regclass('material_cube_buildings') IS NOT NULL")
+            dirty_only=dirty_only and cur.fetchone()[0] # The first refresh builds the whole cube
+            cur.execute("""
+            CREATE TABLE IF NOT EXISTS material_cube (
+                kommunekode smallint,
+                use_code character varying,
+                decade smallint,
+                element character varying,
+                material_type character varying,
+                weight double precision)""")
+            cur.execute("""
+            CREATE TABLE IF NOT EXISTS material_cube_buildings (
+                bbr_id character varying(50) PRIMARY KEY,
+                kommunekode smallint,
+                use_code character varying,
+                decade smallint)""")
+            # NULL dimensions form cells of their own, so cells are matched on these expressions
+            cur.execute("CREATE INDEX IF NOT EXISTS material_cube_buildings_cell ON material_cube_buildings (%s)" % (cube_cell % ('','','')))
+            buildings_sql="""
+            INSERT INTO material_cube_buildings(bbr_id, kommunekode, use_code, decade)
+            SELECT b.id_lokalId, b.kommunekode, b.byg021BygningensAnvendelse, (b.byg026Opførelsesår/10)*10
+            FROM buildings b
+            """
+            cube_sql="""
+            INSERT INTO material_cube(kommunekode, use_code, decade, element, material_type, weight)
+            SELECT
+            mcb.kommunekode,
+            mcb.use_code,
+            mcb.decade,
+            rw.element,
+            rw.material_type,
+            SUM(rw.weight::double precision) -- Summed in double precision, so that cells do not depend on the order of the rows
+            FROM material_cube_buildings mcb
+            INNER JOIN results_weights rw ON rw.bbr_id = mcb.bbr_id
+            """
+            if dirty_only:
+                cur.execute("CREATE TEMP TABLE cube_cells (kommunekode smallint, use_code character varying, decade smallint) ON COMMIT DROP")
+                cur.execute("""
+                INSERT INTO cube_cells
+                SELECT %s FROM material_cube_buildings mcb WHERE mcb.bbr_id IN (SELECT bbr_id FROM buildings_refresh)
+                UNION
+                SELECT COALESCE(b.kommunekode,-1), COALESCE(b.byg021BygningensAnvendelse,''), COALESCE((b.byg026Opførelsesår/10)*10,-1)
+                FROM buildings b WHERE b.id_lokalId IN (SELECT bbr_id FROM buildings_refresh)
+                """ % (cube_cell % ('mcb.','mcb.','mcb.')))
+                cur.execute("DELETE FROM material_cube_buildings WHERE bbr_id IN (SELECT bbr_id FROM buildings_refresh)")
+                cur.execute(buildings_sql+"WHERE b.id_lokalId IN (SELECT bbr_id FROM buildings_refresh)")
+                cur.execute("DELETE FROM material_cube mc USING cube_cells c WHERE (%s) = (c.kommunekode, c.use_code, c.decade)" % (cube_cell % ('mc.','mc.','mc.')))
+                cur.execute(cube_sql+"""INNER JOIN cube_cells c ON (%s) = (c.kommunekode, c.use_code, c.decade)
+                GROUP BY 1, 2, 3, 4, 5""" % (cube_cell % ('mcb.','mcb.','mcb.')))
+            else:
+                cur.execute("TRUNCATE material_cube, material_cube_buildings")
+                cur.execute(buildings_sql)
+                cur.execute(cube_sql+"GROUP BY 1, 2, 3, 4, 5")
+            cur.execute("CREATE INDEX IF NOT EXISTS material_cube_kommunekode ON material_cube (kommunekode, use_code, decade)")
+            conn.commit()
+            if not dirty_only:
+                cur.execute("ANALYZE material_cube, material_cube_buildings")
+                conn.commit()
+            cur.close()
+            return True
 
+        except (Exception, pg.DatabaseError) as error:
+            print(error)
+            return False
+        finally:
+            if conn is not None:
+                self.pool.putconn(conn)
+
+    def material_cube(self,by=('material_type',),**filters):
+        # Rolls the cube up to the dimensions in by (see cube_dimensions), e.g. material_cube(by=['kommunekode','material_type']).
+        # filters restrict the other dimensions to one value or a list of values, e.g. material_cube(by=['element'],kommunekode=[101,147],decade=1960).
+        # Values are converted to the type of the dimension (use codes can be given as numbers), and None selects the cells where the dimension is unknown.
+        by=list(by)
+        for dimension in by+list(filters):
+            if dimension not in cube_dimensions:
+                raise ValueError('unknown dimension of the material cube: '+str(dimension))
+        where=[]
+        params=[]
+        for dimension,value in filters.items():
+            values=list(value) if isinstance(value,(list,tuple,set,np.ndarray)) else [value]
+            to_python,sql_type=cube_types[dimension]
+            try:
+                known=[to_python(v) for v in values if v is not None]
+            except (TypeError,ValueError):
+                raise ValueError('invalid value of %s in the material cube: %s' % (dimension,value))
+            conditions=[]
+            if known:
+                conditions.append(dimension+" = ANY(%s::"+sql_type+"[])")
+                params.append(known)
+            if len(known)<len(values):
+                conditions.append(dimension+" IS NULL")
+            where.append('('+' OR '.join(conditions)+')' if conditions else 'FALSE')
+        sql="SELECT "+''.join([d+', ' for d in by])+"SUM(weight) weight FROM material_cube"
+        if where:
+            sql+=" WHERE "+' AND '.join(where)
+        if by:
+            sql+=" GROUP BY "+', '.join(by)+" ORDER BY "+', '.join(by)
+        try:
+            return self.fetch_frame(sql,tuple(params),categorical=('element','material_type'),server_side=False)
 
+        except (Exception, pg.DatabaseError) as error:
+            print(error)
 
+# Asynchronous version of the query functions of macrocomponent_database (properties_*, results_* and material_amounts_*), for asyncio applications.
+# Queries run on a pool of asynchronous connections, so that many lookups can be in flight at the same time without blocking the event loop.
+# Cancelling a task (e.g. with asyncio.wait_for) cancels its query on the server, and the connection goes back to the pool.
+# Unlike in macrocomponent_database, errors are raised rather than printed, so that the caller can handle them.
+class async_macrocomponent_database:
+    def __init__(self,db_params,batch_size=10000,pool_min_size=1,pool_max_size=10):
+        # The pool is opened by open(), or when entering an "async with" block
+        self.pool=AsyncConnectionPool(db_params,min_size=pool_min_size,max_size=pool_max_size,check=AsyncConnectionPool.check_connection,open=False)
+        self.batch_size=batch_size
+        self.weights_checked=False # See ensure_weights
+
+    async def open(self):
+        await self.pool.open()
+
+    async def close(self):
+        await self.pool.close()
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self,exc_type,exc_value,traceback):
+        await self.close()
+
+    async def frame(self,conn,sql,params=None,categorical=(),server_side=False):
+        # Lookups of a few buildings are fetched in a single round-trip, whole-stock queries through a server-side cursor in batches of batch_size rows
+        # The cursor is closed even if the query or the construction of the DataFrame fails, so that the connection goes back to the pool without it
+        if server_side:
+            async with conn.cursor(name='fetch_frame') as cur:
+                await cur.execute(sql,params)
+                rows=await cur.fetchmany(self.batch_size)
+                builder=frame_builder(cur.description,categorical)
+                while len(rows)>0:
+                    builder.add(rows)
+                    rows=await cur.fetchmany(self.batch_size)
+        else:
+            async with conn.cursor() as cur:
+                await cur.execute(sql,params)
+                builder=frame_builder(cur.description,categorical)
+                builder.add(await cur.fetchall())
+        return builder.frame()
+
+    async def fetch_frame(self,sql,params=None,categorical=(),server_side=False):
+        async with self.pool.connection() as conn:
+            return await self.frame(conn,sql,params,categorical,server_side)
+
+    async def ensure_weights(self):
+        # Same as macrocomponent_database.ensure_weights
+        if self.weights_checked:
+            return
+        async with self.pool.connection() as conn:
+            await conn.execute(ensure_weights_sql[0])
+            cur=await conn.execute(ensure_weights_sql[1])
+            if (await cur.fetchone())[0]:
+                await conn.execute(results_weights_table_sql)
+                await conn.execute(results_weights_index_sql)
+                await conn.execute(results_weights_insert_sql)
+        self.weights_checked=True
+
+    async def properties_buildings(self,parameter_list,bbr_ids):
+        results=await self.fetch_frame(properties_sql(parameter_list,"WHERE id_lokalId = ANY(%s)"),([str(b) for b in bbr_ids],))
+        return properties_index(results,parameter_list)
+
+    async def properties_one_building(self,parameter_list,bbr_id):
+        return await self.properties_buildings(parameter_list,[bbr_id])
+
+    async def properties_all_buildings(self,parameter_list):
+        results=await self.fetch_frame(properties_sql(parameter_list),server_side=True)
+        return properties_index(results,parameter_list)
+
+    async def results_buildings(self,bbr_ids):
+        await self.ensure_weights()
+        results=await self.fetch_frame(results_sql("WHERE rw.bbr_id = ANY(%s)",'bbr_id, element'),([str(b) for b in bbr_ids],),result_categories)
+        results.index=results['bbr_id'].tolist()
+        return results
+
+    async def results_one_building(self,bbr_id):
+        results=await self.results_buildings([bbr_id])
+        return results.reset_index(drop=True)
+
+    async def results_all_buildings(self):
+        await self.ensure_weights()
+        return await self.fetch_frame(results_sql(),categorical=result_categories,server_side=True)
+
+    async def material_amounts_frame(self,where='',params=(),server_side=False):
+        await self.ensure_weights()
+        async with self.pool.connection() as conn:
+            cur=await conn.execute(material_types_sql)
+            materials=[r[0] for r in await cur.fetchall()]
+            results=await self.frame(conn,material_amounts_sql(materials,where),tuple(materials)+tuple(params),server_side=server_side)
+        results.columns=['bbr_id']+material_columns(materials)
+        results.index=results['bbr_id'].tolist()
+        return results
+
+    async def material_amounts_buildings(self,bbr_ids):
+        return await self.material_amounts_frame("WHERE rw.bbr_id = ANY(%s)",([str(b) for b in bbr_ids],))
+
+    async def material_amounts_one_building(self,bbr_id):
+        return await self.material_amounts_buildings([bbr_id])
+
+    async def material_amounts_all(self):
+        return await self.material_amounts_frame(server_side=True)